@@ -0,0 +1,266 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import openpyxl
+
+from excel_comparator_advanced import (
+    ColumnWidths, SheetCache, autofit_columns, compare_sheets, new_output_workbook,
+    write_output_sheet
+)
+
+# Headless benchmark of the comparison pipeline. It generates a synthetic
+# workbook pair, runs each stage of a compare-and-save on it the way the app
+# does, and writes one JSON line per case so runs can be diffed across
+# versions:
+#
+#   python benchmark.py --rows 10000,100000 --cols 8 --repeat 3 --output bench.jsonl
+#
+# With several row counts, the growth of each stage's time per row from the
+# first case to the last is printed too. Similarity blocking should stay near
+# linear (per-row time about x1) on its worst case, dense text codes:
+#
+#   python benchmark.py --rows 8000,16000,32000 --cols 6 --cell-type text --similarity 0.8
+
+CELL_TYPES = ("text", "int", "float", "date", "mixed")
+
+OUTPUT_OPTIONS = {
+    "header_font": "Segoe UI", "header_size": 13, "header_fill": "#f5f1e3", "header_fontcolor": "#222222",
+    "header_border_thick": 2, "header_border_color": "#333333",
+    "body_font": "Segoe UI", "body_size": 12, "body_fill": "#ffffff", "body_fontcolor": "#222222",
+    "body_border_thick": 1, "body_border_color": "#aaaaaa",
+    "match_highlight": "#c6efce", "partial_highlight": "#fff2cc", "nomatch_highlight": "#ffffff",
+    "similar_highlight": "#ddebf7", "diff_highlight": "#f8cbad",
+    "header_height": 24, "body_height": 18, "padding": 2, "autofit_sample_rows": 0,
+}
+
+def cell_value(rng, kind, col):
+    if kind == "mixed":
+        kind = CELL_TYPES[col % 4]
+    if kind == "text":
+        return "v%d-%d" % (col, rng.randint(0, 10 ** 6))
+    if kind == "int":
+        return rng.randint(0, 10 ** 6)
+    if kind == "float":
+        return round(rng.uniform(0, 10 ** 4), 2)
+    return datetime.datetime(2020, 1, 1) + datetime.timedelta(days=rng.randint(0, 3650))
+
+def generate_pair(path1, path2, rows, cols, match_ratio=0.5, partial_ratio=0.25, duplicate_rate=0.0,
+                  cell_type="mixed", blank_rate=0.0, seed=0):
+    # File 1 gets rows random rows. File 2 copies match_ratio of them
+    # unchanged, partial_ratio of them with half their cells changed, and
+    # fills the rest with fresh rows, in shuffled order. duplicate_rate of
+    # each file's rows repeat an earlier row of the same file and blank_rate
+    # of the cells are left empty, except in the last column so that every
+    # row is read back at full width.
+    rng = random.Random(seed)
+    def fresh():
+        return [None if blank_rate and c < cols - 1 and rng.random() < blank_rate
+                else cell_value(rng, cell_type, c) for c in range(cols)]
+    def with_duplicates(data):
+        for i in range(1, len(data)):
+            if duplicate_rate and rng.random() < duplicate_rate:
+                data[i] = list(data[rng.randrange(i)])
+        return data
+    data1 = with_duplicates([fresh() for _ in range(rows)])
+    sources = list(range(rows))
+    rng.shuffle(sources)
+    matched = int(rows * match_ratio)
+    partial = min(rows - matched, int(rows * partial_ratio))
+    data2 = [list(data1[i]) for i in sources[:matched]]
+    for i in sources[matched:matched + partial]:
+        row = list(data1[i])
+        for c in rng.sample(range(cols), max(1, cols // 2)):
+            row[c] = cell_value(rng, cell_type, c)
+        data2.append(row)
+    data2.extend(fresh() for _ in range(rows - matched - partial))
+    rng.shuffle(data2)
+    data2 = with_duplicates(data2)
+    for path, data in ((path1, data1), (path2, data2)):
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet("Data")
+        ws.append(["Column %d" % (c + 1) for c in range(cols)])
+        for row in data:
+            ws.append(row)
+        wb.save(path)
+
+class Stopwatch:
+    # Best-of-repeat and median wall time per stage, with the rows each
+    # stage handled.
+    def __init__(self):
+        self.times = {}
+        self.rows = {}
+
+    def time(self, stage, rows, fn, *args, **kwargs):
+        start = time.perf_counter()
+        value = fn(*args, **kwargs)
+        self.times.setdefault(stage, []).append(time.perf_counter() - start)
+        self.rows[stage] = rows
+        return value
+
+    def report(self):
+        stages = {}
+        for stage, times in self.times.items():
+            best = min(times)
+            stages[stage] = {
+                "seconds": round(best, 6),
+                "median_seconds": round(statistics.median(times), 6),
+                "rows": self.rows[stage],
+                "rows_per_second": round(self.rows[stage] / best) if best else None,
+            }
+        return stages
+
+def load_both(cache, paths, columns=None):
+    return [cache.rows(path, "Data", None, columns) for path in paths]
+
+def write_sheets(result, headers1, headers2, mapping, write_only):
+    wb = new_output_workbook(write_only)
+    extra_headers, differences = result.layout
+    for title, row_info, headers, sheet_mapping, is_file1 in (
+            ("File1", result.row_info_A, headers1, mapping, True),
+            ("File2", result.row_info_B, headers2, result.reverse_mapping, False)):
+        write_output_sheet(wb.create_sheet(title), row_info, headers, OUTPUT_OPTIONS, sheet_mapping, is_file1,
+                           False, None, extra_headers, differences)
+    return wb
+
+def measure_autofit(result, headers1, headers2):
+    # The widths write_output_sheet collects while writing, measured and
+    # applied on their own.
+    wb = new_output_workbook()
+    for row_info, headers in ((result.row_info_A, headers1), (result.row_info_B, headers2)):
+        ws = wb.create_sheet()
+        widths = ColumnWidths(len(headers) + 1, OUTPUT_OPTIONS["autofit_sample_rows"])
+        widths.add(list(headers) + ["MatchType"])
+        for row, status, *_ in row_info:
+            widths.add(list(row) + [status])
+        autofit_columns(ws, OUTPUT_OPTIONS["padding"], widths.lengths)
+
+def run_case(args, rows, workdir):
+    path1 = os.path.join(workdir, "bench_%d_a.xlsx" % rows)
+    path2 = os.path.join(workdir, "bench_%d_b.xlsx" % rows)
+    out = os.path.join(workdir, "bench_%d_out.xlsx" % rows)
+    start = time.perf_counter()
+    generate_pair(path1, path2, rows, args.cols, args.match_ratio, args.partial_ratio, args.duplicates,
+                  args.cell_type, args.blanks, args.seed)
+    generated = time.perf_counter() - start
+    paths = (path1, path2)
+    include = list(range(args.cols - args.skip_columns))
+    mapped = args.mapped if args.mapped is not None else args.cols
+    mapping = {c: c for c in range(mapped) if c in include}
+    both = 2 * rows
+    watch = Stopwatch()
+    result = None
+    for _ in range(args.repeat):
+        # reload_data: a full read of both sheets through openpyxl and
+        # through the fast reader, then again from the sheet cache.
+        watch.time("load_openpyxl", both, load_both, SheetCache(fast_reader=False), paths)
+        cache = SheetCache(fast_reader=True)
+        watch.time("load_fast", both, load_both, cache, paths)
+        watch.time("load_cached", both, load_both, cache, paths)
+        # Projection of the cached sheets down to the included columns, and
+        # a fresh read that projects while parsing, which the comparison uses.
+        watch.time("projection", both, load_both, cache, paths, include)
+        data1, data2 = watch.time("load_projected", both, load_both, SheetCache(fast_reader=True), paths, include)
+        result = watch.time("compare", both, compare_sheets, data1, data2, mapping,
+                            similarity=args.similarity, pair_rows=args.pair_rows)
+        watch.time("sort", both, result.sort_by_match)
+        # write_output_sheet includes measuring and applying column widths;
+        # autofit times that part on its own.
+        wb = watch.time("write_output_sheet", both, write_sheets, result, data1[0], data2[0], mapping,
+                        args.write_only)
+        watch.time("autofit", both, measure_autofit, result, data1[0], data2[0])
+        watch.time("save", both, wb.save, out)
+    stages = watch.report()
+    load_fast = stages["load_fast"]["seconds"]
+    return {
+        "rows": rows,
+        "columns": args.cols,
+        "mapped": len(mapping),
+        "params": {
+            "match_ratio": args.match_ratio, "partial_ratio": args.partial_ratio,
+            "duplicates": args.duplicates, "cell_type": args.cell_type, "blanks": args.blanks,
+            "seed": args.seed, "similarity": args.similarity,
+            "pair_rows": args.pair_rows, "write_only": args.write_only, "repeat": args.repeat,
+        },
+        "generate_seconds": round(generated, 3),
+        "file_bytes": [os.path.getsize(path1), os.path.getsize(path2)],
+        "counts": {"file1": result.counts(file1=True), "file2": result.counts(file1=False)},
+        "fast_reader_speedup": round(stages["load_openpyxl"]["seconds"] / load_fast, 2) if load_fast else None,
+        "stages": stages,
+    }
+
+def environment():
+    return {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "openpyxl": openpyxl.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+def print_case(case, file):
+    print("%d rows x %d columns (fast reader x%s)" % (case["rows"], case["columns"], case["fast_reader_speedup"]),
+          file=file)
+    for stage, info in case["stages"].items():
+        print("  %-20s %9.3fs %12s rows/s" % (stage, info["seconds"], info["rows_per_second"]), file=file)
+
+def print_scaling(cases, file):
+    # Per-row time of each stage in the last case relative to the first; x1
+    # is linear growth.
+    first, last = cases[0], cases[-1]
+    print("scaling %d -> %d rows (x%.1f)" % (first["rows"], last["rows"], last["rows"] / first["rows"]), file=file)
+    for stage, info in last["stages"].items():
+        before = first["stages"][stage]
+        if before["seconds"] and info["seconds"]:
+            growth = (info["seconds"] / last["rows"]) / (before["seconds"] / first["rows"])
+            print("  %-20s x%.2f per row" % (stage, growth), file=file)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Excel comparator pipeline on synthetic workbooks.")
+    parser.add_argument("--rows", default="10000", help="data rows per file, comma separated for several cases")
+    parser.add_argument("--cols", type=int, default=8)
+    parser.add_argument("--mapped", type=int, default=None, help="mapped columns (default: all)")
+    parser.add_argument("--skip-columns", type=int, default=0, help="trailing columns left out of the comparison")
+    parser.add_argument("--match-ratio", type=float, default=0.5)
+    parser.add_argument("--partial-ratio", type=float, default=0.25)
+    parser.add_argument("--duplicates", type=float, default=0.0, help="fraction of rows repeating an earlier row")
+    parser.add_argument("--blanks", type=float, default=0.0, help="fraction of empty cells")
+    parser.add_argument("--cell-type", choices=CELL_TYPES, default="mixed")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--similarity", type=float, default=None, help="Similar Match threshold (0-1]")
+    parser.add_argument("--pair-rows", action="store_true")
+    parser.add_argument("--write-only", action="store_true", help="streaming (write-only) output workbooks")
+    parser.add_argument("--workdir", default=None, help="keep the generated workbooks here")
+    parser.add_argument("--output", default=None, help="append JSON lines here instead of printing them")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    env = environment()
+    cases = []
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = args.workdir or tmp
+        os.makedirs(workdir, exist_ok=True)
+        for rows in (int(n) for n in args.rows.split(",")):
+            case = dict(run_case(args, rows, workdir), environment=env)
+            cases.append(case)
+            print_case(case, sys.stderr)
+            line = json.dumps(case, sort_keys=True, default=str)
+            if args.output:
+                with open(args.output, "a") as f:
+                    f.write(line + "\n")
+            else:
+                print(line)
+    if len(cases) > 1:
+        print_scaling(cases, sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,58 @@
 import tkinter as tk
 from ttkbootstrap import Style
 from ttkbootstrap.widgets import (
-    LabelFrame, Frame, Button, Label, Entry, Combobox, Spinbox, Checkbutton
+    LabelFrame, Frame, Button, Label, Entry, Combobox, Spinbox, Checkbutton, Progressbar
 )
 from tkinter import filedialog, colorchooser, font, messagebox
 import openpyxl
+from openpyxl.reader.excel import ExcelReader
+from openpyxl.styles.stylesheet import apply_stylesheet
+from openpyxl.utils.cell import column_index_from_string, range_boundaries
+from openpyxl.utils.datetime import from_excel, from_ISO8601
+from openpyxl.xml.constants import SHEET_MAIN_NS
+import cProfile
+import contextlib
+import csv
+import io
 import json
 import os
+import pstats
 import difflib
+import datetime
+import hashlib
+import heapq
+import itertools
+import math
+import pickle
+import queue
+import tempfile
+import threading
+import time
+import tracemalloc
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from xml.parsers import expat
 
 SETTINGS_FILE = "excel_comparator_settings.json"
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(SETTINGS_FILE)), "excel_comparator_cache")
+RUN_LOG_FILE = os.path.join(os.path.dirname(os.path.abspath(SETTINGS_FILE)), "excel_comparator_runs.jsonl")
+PROFILE_TOP = 30
 RECENT_LIMIT = 10
+SPILL_BLOCK = 5000
+PROGRESS_STEP = 2000
+SIMILARITY_BLOCK_LIMIT = 256
+SIMILARITY_TOP = 8
+SIMILARITY_SCAN_LIMIT = 128
+PARTNER_SCAN_LIMIT = 512
+XML_BYTES_PER_CELL = 40
+SKETCH_SIZE = 64
+SKETCH_MIN_DISTINCT = 8
+SUGGEST_SAMPLE_ROWS = 2000
+SUGGEST_SAMPLE_CELLS = 500000
+SUGGEST_POSTING_LIMIT = 64
+HEADER_CUTOFF = 0.8
+VALUE_CUTOFF = 0.5
 
 def safe_color(color):
     if not color: color = "#FFFFFF"
@@ -34,33 +76,2276 @@ def get_border(thickness, color):
     side = Side(border_style=border_style, color=safe_color(color))
     return openpyxl.styles.Border(left=side, right=side, top=side, bottom=side)
 
-def autofit_columns(ws, extra_padding=2):
-    for col in ws.columns:
-        max_length = 0
-        col_letter = openpyxl.utils.get_column_letter(col[0].column)
-        for cell in col:
-            val = str(cell.value) if cell.value is not None else ""
-            max_length = max(max_length, len(val))
-        ws.column_dimensions[col_letter].width = min(50, max(8, max_length + extra_padding))
+def build_style_table(wb, opts):
+    # One named style per header/body/status-column and match type, registered
+    # once per workbook, so every output cell takes a single style assignment.
+    # Values must be set after the style so date cells keep their number format.
+    from openpyxl.styles import NamedStyle, Alignment
+    from openpyxl.styles.borders import DEFAULT_BORDER
+    align_center = Alignment(horizontal="center", vertical="center")
+    bfont = get_font(opts["body_font"], opts["body_size"], False, opts["body_fontcolor"])
+    bold_font = get_font(opts["body_font"], opts["body_size"], True, opts["body_fontcolor"])
+    bborder = get_border(opts["body_border_thick"], opts["body_border_color"])
+    specs = {
+        "Comparator Header": (
+            get_font(opts["header_font"], opts["header_size"], True, opts["header_fontcolor"]),
+            get_fill(opts["header_fill"]),
+            get_border(opts["header_border_thick"], opts["header_border_color"]),
+        ),
+        "Comparator Difference": (bold_font, get_fill(opts["diff_highlight"]), bborder),
+    }
+    for status, highlight, font in (
+        ("Full Match", "match_highlight", bfont),
+        ("Partial Match", "partial_highlight", bold_font),
+        ("No Match", "nomatch_highlight", bold_font),
+        ("Similar Match", "similar_highlight", bfont),
+    ):
+        fill = get_fill(opts[highlight])
+        specs[f"Comparator {status}"] = (font, fill, bborder)
+        specs[f"Comparator {status} Type"] = (font, fill, DEFAULT_BORDER)
+    existing = set(wb.named_styles)
+    for name, (font, fill, border) in specs.items():
+        if name not in existing:
+            wb.add_named_style(NamedStyle(name=name, font=font, fill=fill, border=border, alignment=align_center))
+    table = {"header": "Comparator Header", "difference": "Comparator Difference"}
+    for status in STATUS_LABELS:
+        table[status] = (f"Comparator {status}", f"Comparator {status} Type")
+    return table
+
+class ColumnWidths:
+    # Longest str() length per output column, collected while rows are
+    # written. With sample_rows set, only the header and the first
+    # sample_rows data rows are measured.
+    def __init__(self, ncols, sample_rows=0):
+        self.lengths = array("l", [0]) * ncols
+        self.sample_rows = sample_rows
+        self.rows = 0
+
+    def add(self, values):
+        if self.sample_rows and self.rows > self.sample_rows:
+            return
+        self.rows += 1
+        lengths = self.lengths
+        for i, value in enumerate(values):
+            if value is not None:
+                n = len(str(value))
+                if n > lengths[i]: lengths[i] = n
+
+def autofit_columns(ws, extra_padding, lengths):
+    for col_idx, length in enumerate(lengths, 1):
+        col_letter = openpyxl.utils.get_column_letter(col_idx)
+        ws.column_dimensions[col_letter].width = min(50, max(8, length + extra_padding))
+
+def new_output_workbook(write_only=False):
+    wb = openpyxl.Workbook(write_only=write_only)
+    if not write_only:
+        wb.remove(wb.active)
+    return wb
+
+def resolve_workers(value):
+    try:
+        workers = int(value)
+    except (TypeError, ValueError):
+        workers = 1
+    return workers if workers > 0 else (os.cpu_count() or 1)
+
+class Cancelled(Exception):
+    pass
+
+class Progress:
+    # Written by a worker thread, read by the Tk loop. total == 0 means the
+    # row count of the current stage is not known in advance. Wall time and
+    # rows are also summed per stage name for the run summary and log.
+    def __init__(self):
+        self.stage = ""
+        self.done = 0
+        self.total = 0
+        self.cancel_event = threading.Event()
+        self.started = time.perf_counter()
+        self.timings = OrderedDict()
+        self._since = self.started
+        self._since_done = 0
+
+    def _lap(self):
+        now = time.perf_counter()
+        if self.stage:
+            entry = self.timings.setdefault(self.stage, [0.0, 0])
+            entry[0] += now - self._since
+            entry[1] += self.done - self._since_done
+        self._since, self._since_done = now, self.done
+
+    def start(self, stage, total=0):
+        self.check()
+        self._lap()
+        self.stage, self.done, self.total = stage, 0, total
+        self._since_done = 0
+
+    @contextlib.contextmanager
+    def phase(self, stage, rows=0):
+        # Times a step inside the current stage (saving, autofit) as a stage
+        # of its own; the row counts of the outer stage carry on afterwards.
+        self._lap()
+        outer, self.stage = self.stage, stage
+        try:
+            yield
+        finally:
+            self._lap()
+            self.timings[stage][1] += rows
+            self.stage = outer
+
+    def finish(self):
+        self._lap()
+        self.stage = ""
+
+    def stage_timings(self):
+        # [(stage, seconds, rows)] in the order the stages first ran.
+        return [(stage, seconds, rows) for stage, (seconds, rows) in self.timings.items()]
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def advance(self, rows):
+        self.done += rows
+        self.check()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def check(self):
+        if self.cancel_event.is_set():
+            raise Cancelled()
+
+def timed(progress, stage, rows=0):
+    # progress.phase() that also accepts progress=None.
+    return progress.phase(stage, rows) if progress is not None else contextlib.nullcontext()
+
+def format_timings(timings):
+    lines = []
+    for stage, seconds, rows in timings:
+        rate = f", {rows / seconds:,.0f} rows/s" if rows and seconds else ""
+        lines.append(f"  {stage}: {seconds:.2f} s" + (f", {rows:,} rows{rate}" if rows else ""))
+    return "\n".join(lines)
+
+def tracked(iterable, progress):
+    # Passes items through, reporting them to progress every PROGRESS_STEP.
+    if progress is None:
+        return iterable
+    return _tracked(iterable, progress)
+
+def _tracked(iterable, progress):
+    count = 0
+    for item in iterable:
+        yield item
+        count += 1
+        if count == PROGRESS_STEP:
+            progress.advance(count)
+            count = 0
+    progress.advance(count)
 
 def mapping_str_to_int(d):
     return {int(k): int(v) for k, v in d.items()}
 
-def suggest_mappings(headers1, headers2):
+def sketch_key(value):
+    # Lenient text of a cell for value sketches: 3 and 3.0 agree, text
+    # ignores case and surrounding spaces.
+    if type(value) is str:
+        return value.strip().casefold()
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    elif isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value).strip().casefold()
+
+class ColumnSketch:
+    # Bottom-k sketch of a column's distinct values: the SKETCH_SIZE smallest
+    # 64-bit value hashes, in ascending order. Two sketches estimate the Jaccard similarity of
+    # their value sets (a one-hash MinHash), and the k-th smallest hash
+    # estimates the distinct count the way HyperLogLog does. Hashes are only
+    # comparable within one process.
+    __slots__ = ("hashes", "distinct")
+
+    def __init__(self, values, k=SKETCH_SIZE):
+        hashes = {hash(sketch_key(v)) & 0xFFFFFFFFFFFFFFFF for v in values if v is not None and v != ""}
+        self.hashes = heapq.nsmallest(k, hashes)
+        if len(hashes) <= k:
+            self.distinct = len(hashes)
+        else:
+            self.distinct = int((k - 1) * 2 ** 64 / (self.hashes[-1] + 1))
+
+    def jaccard(self, other):
+        # Share of the k smallest hashes of the union held by both sketches,
+        # from one merge of the two sorted hash lists.
+        a, b = self.hashes, other.hashes
+        if not a or not b:
+            return 0.0
+        k = max(len(a), len(b))
+        end_a, end_b = len(a), len(b)
+        i = j = seen = shared = 0
+        while seen < k:
+            if i == end_a:
+                seen = min(k, seen + end_b - j)
+                break
+            if j == end_b:
+                seen = min(k, seen + end_a - i)
+                break
+            x, y = a[i], b[j]
+            if x < y:
+                i += 1
+            elif y < x:
+                j += 1
+            else:
+                i += 1
+                j += 1
+                shared += 1
+            seen += 1
+        return shared / seen
+
+    def overlap(self, other):
+        # Estimated share of the smaller value set found in the larger one,
+        # damped for columns with too few distinct values to tell apart.
+        jaccard = self.jaccard(other)
+        smaller = min(self.distinct, other.distinct)
+        if not jaccard or not smaller:
+            return 0.0
+        common = jaccard * (self.distinct + other.distinct) / (1 + jaccard)
+        return min(1.0, common / smaller) * min(1.0, smaller / SKETCH_MIN_DISTINCT)
+
+def sample_size(width):
+    # Rows sampled for sketches; wide sheets get fewer so a sample stays
+    # near SUGGEST_SAMPLE_CELLS.
+    return max(100, min(SUGGEST_SAMPLE_ROWS, SUGGEST_SAMPLE_CELLS // max(1, width)))
+
+def spread_sample(rows, count):
+    return rows[::max(1, len(rows) // count)][:count]
+
+def column_sketches(rows, width):
+    # One ColumnSketch per column of rows, which may be ragged.
+    return [ColumnSketch(row[col] for row in rows if col < len(row)) for col in range(width)]
+
+def header_grams(header):
+    # (header text without case or punctuation, its character trigrams).
+    text = "".join(ch for ch in str(header).casefold() if ch.isalnum())
+    padded = f" {text} "
+    return text, {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def typo_keys(text):
+    # The text and each copy of it with one character dropped. Texts one
+    # typo apart (a substitution, insertion, deletion or swap of adjacent
+    # characters) share at least one of these keys.
+    return {text} | {text[:i] + text[i + 1:] for i in range(len(text))}
+
+def header_similarity(text1, grams1, text2, grams2):
+    # Dice coefficient of the trigrams, or difflib's ratio when higher so
+    # typos score as they always have.
+    dice = 2 * len(grams1 & grams2) / (len(grams1) + len(grams2))
+    if dice >= HEADER_CUTOFF:
+        return dice
+    matcher = difflib.SequenceMatcher(None, text1, text2)
+    if matcher.real_quick_ratio() < HEADER_CUTOFF or matcher.quick_ratio() < HEADER_CUTOFF:
+        return dice
+    return max(dice, matcher.ratio())
+
+def candidate_pairs(keys1, keys2):
+    # {(i1, i2): keys shared} for the columns sharing at least one key, from
+    # an inverted index of keys2. Keys held by more than
+    # SUGGEST_POSTING_LIMIT columns say little and would make this n*m, so
+    # they are left out.
+    postings = {}
+    for i2, keys in enumerate(keys2):
+        for key in keys:
+            postings.setdefault(key, []).append(i2)
+    # Pairs are counted as the ints i1 * n2 + i2.
+    n2 = len(keys2)
+    hits = []
+    for i1, keys in enumerate(keys1):
+        base = i1 * n2
+        for key in keys:
+            cols = postings.get(key)
+            if cols and len(cols) <= SUGGEST_POSTING_LIMIT:
+                hits.extend([base + i2 for i2 in cols])
+    return {divmod(pair, n2): shared for pair, shared in Counter(hits).items()}
+
+def suggest_mappings(headers1, headers2, sketches1=None, sketches2=None):
+    # One-to-one mapping suggestions. Headers equal but for case are mapped
+    # first. The rest are scored by header_similarity() and, given
+    # ColumnSketch lists aligned with the headers, by value overlap; pairs
+    # scoring at least HEADER_CUTOFF overall or VALUE_CUTOFF on values alone
+    # are taken best first. Only columns sharing a trigram or a sketched
+    # value, or one typo apart, are scored, so wide sheets stay fast.
     mapping = {}
-    headers2_lower = [h.lower() for h in headers2]
-    for i, h1 in enumerate(headers1):
-        h1_lower = str(h1).lower()
-        if h1_lower in headers2_lower:
-            mapping[i] = headers2_lower.index(h1_lower)
+    taken = set()
+    exact = {}
+    for i2, h2 in enumerate(headers2):
+        exact.setdefault(str(h2).lower(), []).append(i2)
+    for i1, h1 in enumerate(headers1):
+        free = [i2 for i2 in exact.get(str(h1).lower(), ()) if i2 not in taken]
+        if free:
+            mapping[i1] = free[0]
+            taken.add(free[0])
+    rest1 = [i for i in range(len(headers1)) if i not in mapping]
+    rest2 = [i for i in range(len(headers2)) if i not in taken]
+    if not rest1 or not rest2:
+        return mapping
+    grams1 = [header_grams(headers1[i]) for i in rest1]
+    grams2 = [header_grams(headers2[i]) for i in rest2]
+    scores = {}
+    # Headers sharing under a quarter of the shorter one's trigrams are too
+    # far apart to reach HEADER_CUTOFF and are not scored.
+    for (j1, j2), shared in candidate_pairs([g for _, g in grams1], [g for _, g in grams2]).items():
+        if 4 * shared >= min(len(grams1[j1][1]), len(grams2[j2][1])):
+            scores[(j1, j2)] = [header_similarity(*grams1[j1], *grams2[j2]), 0.0]
+    # One typo in a short header can leave too few shared trigrams for the
+    # test above, so headers one edit apart are scored as well.
+    keys1 = [typo_keys(text) if text else set() for text, _ in grams1]
+    keys2 = [typo_keys(text) if text else set() for text, _ in grams2]
+    for pair in candidate_pairs(keys1, keys2):
+        if pair not in scores:
+            scores[pair] = [header_similarity(*grams1[pair[0]], *grams2[pair[1]]), 0.0]
+    # Headers that differ only in punctuation or spacing share no rare
+    # trigram when their common trigrams are skipped.
+    same_text = {}
+    for j2, (text, _) in enumerate(grams2):
+        same_text.setdefault(text, []).append(j2)
+    for j1, (text, _) in enumerate(grams1):
+        if text:
+            for j2 in same_text.get(text, ()):
+                scores[(j1, j2)] = [1.0, 0.0]
+    if sketches1 is not None and sketches2 is not None:
+        values1 = [sketches1[i] for i in rest1]
+        values2 = [sketches2[i] for i in rest2]
+        for pair in candidate_pairs([v.hashes for v in values1], [v.hashes for v in values2]):
+            scores.setdefault(pair, [0.0, 0.0])[1] = values1[pair[0]].overlap(values2[pair[1]])
+    ranked = []
+    for (j1, j2), (header, values) in scores.items():
+        score = 1 - (1 - header) * (1 - values)
+        if score >= HEADER_CUTOFF or values >= VALUE_CUTOFF:
+            ranked.append((-score, j1, j2))
+    ranked.sort()
+    for _, j1, j2 in ranked:
+        i1, i2 = rest1[j1], rest2[j2]
+        if i1 not in mapping and i2 not in taken:
+            mapping[i1] = i2
+            taken.add(i2)
+    return dict(sorted(mapping.items()))
+
+# STATUS_ORDER holds the stored status codes; STATUS_RANK is the order the
+# statuses are sorted and listed in.
+STATUS_ORDER = {"Full Match": 0, "Partial Match": 1, "No Match": 2, "Similar Match": 3}
+STATUS_LABELS = ("Full Match", "Partial Match", "No Match", "Similar Match")
+STATUS_RANK = {"Full Match": 0, "Similar Match": 1, "Partial Match": 2, "No Match": 3}
+MATCH_TYPES = sorted(STATUS_RANK, key=STATUS_RANK.get)
+
+MISSING = -1
+
+class Normalizer:
+    # Turns a cell value into the text key the engine compares. With every
+    # option off the key is plain str(value), which is what the comparison has
+    # always used. Numbers are rounded to the nearest multiple of tolerance,
+    # which is how the option is labelled: 0.049 and 0.051 with tolerance 0.1
+    # round to 0.0 and 0.1 and do not match.
+    OPTIONS = ("trim", "casefold", "numbers", "tolerance", "dates", "blank_is_empty")
+
+    def __init__(self, trim=False, casefold=False, numbers=False, tolerance=0.0, dates=False, blank_is_empty=False):
+        self.trim = trim
+        self.casefold = casefold
+        self.numbers = numbers
+        self.tolerance = float(tolerance or 0)
+        self.dates = dates
+        self.blank_is_empty = blank_is_empty
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(**{k: v for k, v in (settings or {}).items() if k in cls.OPTIONS})
+
+    def settings(self):
+        return {k: getattr(self, k) for k in self.OPTIONS}
+
+    def options(self):
+        return tuple(getattr(self, k) for k in self.OPTIONS)
+
+    @property
+    def legacy(self):
+        return not (self.trim or self.casefold or self.numbers or self.dates or self.blank_is_empty)
+
+    def keys(self, values):
+        return map(str, values) if self.legacy else map(self.key, values)
+
+    def key(self, value):
+        if value is None:
+            return "" if self.blank_is_empty else "None"
+        if isinstance(value, str):
+            return self._text_key(value)
+        if isinstance(value, bool):
+            return str(value)
+        if isinstance(value, (int, float)):
+            return self._number_key(value) if self.numbers else str(value)
+        if isinstance(value, (datetime.datetime, datetime.date)):
+            return self._date_key(value) if self.dates else str(value)
+        return str(value)
+
+    def _text_key(self, text):
+        if self.trim:
+            text = text.strip()
+        elif self.blank_is_empty and not text.strip():
+            text = ""
+        if not text:
+            return text
+        if self.numbers and (text[0].isdigit() or text[0] in "+-.") and "_" not in text:
+            try:
+                number = float(text)
+            except ValueError:
+                pass
+            else:
+                if number == number and abs(number) != float("inf"):
+                    return self._number_key(int(text) if text.lstrip("+-").isdigit() else number)
+        if self.dates and text[0].isdigit() and len(text) >= 10 and text[4] == "-":
+            try:
+                return self._date_key(datetime.datetime.fromisoformat(text))
+            except ValueError:
+                pass
+        return text.casefold() if self.casefold else text
+
+    def _number_key(self, number):
+        if self.tolerance:
+            number = round(number / self.tolerance) * self.tolerance
+        if isinstance(number, int):
+            return str(number) if abs(number) < 10 ** 15 else format(number, ".15g")
+        if number.is_integer() and abs(number) < 1e15:
+            return str(int(number))
+        return format(number, ".15g")
+
+    def _date_key(self, value):
+        if isinstance(value, datetime.datetime):
+            if value.tzinfo is not None:
+                value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+            if not (value.hour or value.minute or value.second or value.microsecond):
+                return value.date().isoformat()
+            return value.isoformat(sep=" ")
+        return value.isoformat()
+
+LEGACY_NORMALIZER = Normalizer()
+
+class ValueDictionary:
+    # Interns normalized cell values into integer codes; one dictionary is
+    # shared by both sheets so equal values get equal codes on either side.
+    def __init__(self, normalizer=None):
+        self.codes = {}
+        self.normalizer = normalizer or LEGACY_NORMALIZER
+
+    def encode(self, values):
+        codes = self.codes
+        return array("l", [codes.setdefault(v, len(codes)) for v in self.normalizer.keys(values)])
+
+    def copy(self):
+        other = ValueDictionary(self.normalizer)
+        other.codes = dict(self.codes)
+        return other
+
+    def __len__(self):
+        return len(self.codes)
+
+class ColumnarSheet:
+    # Data rows of one sheet plus dictionary-encoded columns. A column is only
+    # normalized and encoded the first time the engine asks for it; cells past
+    # the end of a short row get the MISSING code.
+    def __init__(self, data, dictionary):
+        self.rows = data[1:]
+        self.dictionary = dictionary
+        self.groups = {}
+        for pos, row in enumerate(self.rows):
+            self.groups.setdefault(len(row), array("l")).append(pos)
+        self._columns = {}
+        self._keys = {}
+        self._key_sets = {}
+        self._value_sets = {}
+        self._postings = {}
+
+    def codes(self, col):
+        if col not in self._columns:
+            rows = self.rows
+            if all(col < length for length in self.groups):
+                codes = self.dictionary.encode(row[col] for row in rows)
+            else:
+                present = [pos for pos, row in enumerate(rows) if col < len(row)]
+                codes = array("l", [MISSING]) * len(rows)
+                for pos, code in zip(present, self.dictionary.encode(rows[pos][col] for pos in present)):
+                    codes[pos] = code
+            self._columns[col] = codes
+        return self._columns[col]
+
+    def group_codes(self, length, col):
+        codes = self.codes(col)
+        if len(self.groups) == 1:
+            return codes
+        return array("l", [codes[pos] for pos in self.groups[length]])
+
+    def keys(self, length, cols):
+        key = (length, cols)
+        if key not in self._keys:
+            self._keys[key] = list(zip(*[self.group_codes(length, c) for c in cols]))
+        return self._keys[key]
+
+    def key_set(self, length, cols):
+        key = (length, cols)
+        if key not in self._key_sets:
+            self._key_sets[key] = set(self.keys(length, cols))
+        return self._key_sets[key]
+
+    def value_set(self, length, col):
+        key = (length, col)
+        if key not in self._value_sets:
+            self._value_sets[key] = set(self.group_codes(length, col))
+        return self._value_sets[key]
+
+    def postings(self, col):
+        # code -> positions of the rows holding it in col (MISSING left out).
+        if col not in self._postings:
+            postings = {}
+            for pos, code in enumerate(self.codes(col)):
+                if code != MISSING:
+                    postings.setdefault(code, array("l")).append(pos)
+            self._postings[col] = postings
+        return self._postings[col]
+
+def classify_rows(sheet_main, sheet_other, pairs, progress=None):
+    # Same labels as the old pairwise scan: a mapped pair only counts when both
+    # rows are long enough to hold it, so each length group of the main sheet is
+    # checked against each length group of the other one. Rows are reported to
+    # progress on their first pass only.
+    statuses = ["No Match"] * len(sheet_main.rows)
+    for length_main, positions in sheet_main.groups.items():
+        pending = list(range(len(positions)))
+        reported = 0
+        for length_other in sheet_other.groups:
+            usable = [(i1, i2) for i1, i2 in pairs if i1 < length_main and i2 < length_other]
+            if not usable or not pending:
+                continue
+            cols_main = tuple(i1 for i1, _ in usable)
+            cols_other = tuple(i2 for _, i2 in usable)
+            keys = sheet_main.keys(length_main, cols_main)
+            full = sheet_other.key_set(length_other, cols_other)
+            values = [sheet_other.value_set(length_other, c) for c in cols_other]
+            still_pending = []
+            for n, j in enumerate(pending, 1):
+                if progress is not None and not n % PROGRESS_STEP:
+                    progress.advance(max(0, n - reported))
+                    reported = max(reported, n)
+                key = keys[j]
+                if key in full:
+                    statuses[positions[j]] = "Full Match"
+                    continue
+                if any(v in s for v, s in zip(key, values)):
+                    statuses[positions[j]] = "Partial Match"
+                still_pending.append(j)
+            pending = still_pending
+        if progress is not None:
+            progress.advance(len(positions) - reported)
+    return statuses
+
+def qgrams(text, q=3):
+    padded = "\x02" + text + "\x03"
+    return frozenset(padded[i:i + q] for i in range(len(padded) - q + 1))
+
+def jaccard(a, b):
+    common = len(a & b)
+    return common / (len(a) + len(b) - common)
+
+def _prefix_shared(size, threshold):
+    # Prefix tokens two similar values must share: two once they have to
+    # overlap in at least two q-grams, else one.
+    return 2 if math.ceil(threshold * size - 1e-9) >= 2 else 1
+
+def _prefix_length(size, threshold):
+    return size - math.ceil(threshold * size - 1e-9) + _prefix_shared(size, threshold)
+
+class ColumnBlocker:
+    # Prefix-filter index over the distinct values of one column of the other
+    # sheet. Each value's q-grams are ordered rarest first and only the first
+    # few are indexed, which is enough to find every value whose q-gram
+    # Jaccard similarity with a query reaches threshold. Prefixes are one
+    # token longer than the classic filter needs, so a candidate has to turn
+    # up in two of the query's postings (_prefix_shared); values too short
+    # for that are kept in loose and need only one.
+    def __init__(self, postings, grams, threshold):
+        self.grams = grams
+        self.threshold = threshold
+        self.rows_by_code = postings
+        freq = Counter(tok for code in self.rows_by_code for tok in grams(code))
+        self.rank = {tok: n for n, tok in enumerate(sorted(freq, key=lambda t: (freq[t], t)))}
+        self.index = {}
+        self.loose = set()
+        for code in self.rows_by_code:
+            toks = sorted(grams(code), key=self.rank.__getitem__)
+            for tok in toks[:_prefix_length(len(toks), threshold)]:
+                self.index.setdefault(tok, set()).add(code)
+            if _prefix_shared(len(toks), threshold) == 1:
+                self.loose.add(code)
+        self._similar = {}
+
+    def similar(self, code):
+        # [(other code, similarity)] for every indexed value at or above the
+        # threshold, plus the number of other-sheet rows holding them. When
+        # the prefix postings hold more than SIMILARITY_SCAN_LIMIT values
+        # (values made of a few common q-grams, such as codes, numbers and
+        # dates, in large sheets), only the equal value is returned, so the
+        # work per query stays bounded.
+        if code not in self._similar:
+            grams = self.grams(code)
+            rank = self.rank
+            toks = sorted(grams, key=lambda t: rank.get(t, -1))
+            size = len(grams)
+            postings = [self.index.get(tok, frozenset()) for tok in toks[:_prefix_length(size, self.threshold)]]
+            if sum(map(len, postings)) > SIMILARITY_SCAN_LIMIT:
+                found = [(code, 1.0)] if code in self.rows_by_code else []
+            else:
+                if _prefix_shared(size, self.threshold) == 1:
+                    candidates = set().union(*postings)
+                else:
+                    candidates = set()
+                    for n, a in enumerate(postings):
+                        for b in postings[n + 1:]:
+                            candidates |= a & b
+                        if self.loose:
+                            candidates |= a & self.loose
+                # Jaccard >= t needs t*|a| <= |b| <= |a|/t, so the size check
+                # drops most candidates before any intersection is taken.
+                lo, hi = self.threshold * size - 1e-9, size / self.threshold + 1e-9
+                found = []
+                for c in candidates:
+                    other = self.grams(c)
+                    if lo <= len(other) <= hi:
+                        common = len(grams & other)
+                        sim = common / (size + len(other) - common)
+                        if sim >= self.threshold:
+                            found.append((c, sim))
+            self._similar[code] = (found, sum(len(self.rows_by_code[c]) for c, _ in found))
+        return self._similar[code]
+
+def similarity_scores(sheet_main, sheet_other, pairs, statuses, threshold, progress=None):
+    # Best row similarity of each main row against the other sheet: the mean
+    # q-gram Jaccard similarity over the mapped columns. A row can only reach
+    # threshold if one of its cells does, so candidates are the rows sharing a
+    # similar value in some column (found through ColumnBlocker); columns whose
+    # similar values cover more than SIMILARITY_BLOCK_LIMIT rows are too common
+    # to narrow anything down and are only used for scoring. The
+    # SIMILARITY_TOP candidates with the most similar cells are scored in full.
+    # Rows that are not a Full Match but reach threshold become Similar Match.
+    # Returns the scores and the position of each row's best-scoring
+    # candidate (MISSING for Full Match rows and rows without candidates).
+    scores = [1.0 if status == "Full Match" else 0.0 for status in statuses]
+    partners = array("l", [MISSING]) * len(statuses)
+    if not pairs:
+        return scores, partners
+    main_cols = [sheet_main.codes(i1) for i1, _ in pairs]
+    other_cols = [sheet_other.codes(i2) for _, i2 in pairs]
+    texts = list(sheet_main.dictionary.codes)
+    gram_cache = {}
+    def grams(code):
+        g = gram_cache.get(code)
+        if g is None:
+            g = gram_cache[code] = qgrams(texts[code])
+        return g
+    blockers = [ColumnBlocker(sheet_other.postings(i2), grams, threshold) for _, i2 in pairs]
+    cell_sims = {}
+    def cell_sim(a, b):
+        if a == b:
+            return 0.0 if a == MISSING else 1.0
+        if a == MISSING or b == MISSING:
+            return 0.0
+        sim = cell_sims.get((a, b))
+        if sim is None:
+            sim = cell_sims[(a, b)] = jaccard(grams(a), grams(b))
+        return sim
+    width = len(pairs)
+    seen = {}
+    pending = [pos for pos, status in enumerate(statuses) if status != "Full Match"]
+    for n, pos in enumerate(pending, 1):
+        if progress is not None and not n % PROGRESS_STEP:
+            progress.advance(PROGRESS_STEP)
+        key = tuple(codes[pos] for codes in main_cols)
+        found_best = seen.get(key)
+        if found_best is None:
+            hits = {}
+            narrowest = None
+            for blocker, code in zip(blockers, key):
+                if code == MISSING:
+                    continue
+                found, rows = blocker.similar(code)
+                if rows > SIMILARITY_BLOCK_LIMIT:
+                    if narrowest is None or rows < narrowest[0]:
+                        narrowest = (rows, blocker, found)
+                    continue
+                for c, sim in found:
+                    for r in blocker.rows_by_code[c]:
+                        hits[r] = hits.get(r, 0.0) + sim
+            if not hits and narrowest is not None:
+                _, blocker, found = narrowest
+                rows = itertools.chain.from_iterable(blocker.rows_by_code[c] for c, _ in found)
+                hits = dict.fromkeys(itertools.islice(rows, SIMILARITY_BLOCK_LIMIT), 0.0)
+            best = heapq.nlargest(SIMILARITY_TOP, hits, key=hits.__getitem__)
+            found_best = seen[key] = max(
+                ((sum(cell_sim(a, codes[r]) for a, codes in zip(key, other_cols)) / width, -r) for r in best),
+                default=(0.0, -MISSING))
+        score, partners[pos] = found_best[0], -found_best[1]
+        scores[pos] = score
+        if score >= threshold - 1e-9:
+            statuses[pos] = "Similar Match"
+    if progress is not None:
+        progress.advance(len(pending) % PROGRESS_STEP)
+    return scores, partners
+
+def best_partners(sheet_main, sheet_other, pairs, statuses, similar_partners=None, progress=None):
+    # Position in the other sheet of each main row's counterpart, MISSING for
+    # No Match rows. Full Match rows get the first row with the same key,
+    # Similar Match rows the row that scored best, and Partial Match rows the
+    # row sharing the most mapped values. For the latter, every row holding
+    # one of its rarer values (postings of at most SIMILARITY_BLOCK_LIMIT
+    # rows) is checked in full. Rows in the longer postings, of which only
+    # the first PARTNER_SCAN_LIMIT are scanned, are counted, and the
+    # SIMILARITY_TOP holding the most of those values (two at least) are
+    # checked too; a row holding just one of them cannot beat a rarer
+    # candidate.
+    partners = array("l", [MISSING]) * len(statuses)
+    if not pairs:
+        return partners
+    main_cols = [sheet_main.codes(i1) for i1, _ in pairs]
+    other_cols = [sheet_other.codes(i2) for _, i2 in pairs]
+    postings = [sheet_other.postings(i2) for _, i2 in pairs]
+    first = {}
+    for pos, key in enumerate(zip(*other_cols)):
+        first.setdefault(key, pos)
+    seen = {}
+    for pos, status in enumerate(statuses):
+        if progress is not None and pos and not pos % PROGRESS_STEP:
+            progress.advance(PROGRESS_STEP)
+        if status == "No Match":
+            continue
+        if status == "Similar Match" and similar_partners is not None:
+            partners[pos] = similar_partners[pos]
+            continue
+        key = tuple(codes[pos] for codes in main_cols)
+        if key in first:
+            partners[pos] = first[key]
+            continue
+        partner = seen.get(key)
+        if partner is None:
+            candidates = set()
+            common = []
+            for code, rows_by_code in zip(key, postings):
+                rows = rows_by_code.get(code, ()) if code != MISSING else ()
+                if len(rows) > SIMILARITY_BLOCK_LIMIT:
+                    common.append(rows[:PARTNER_SCAN_LIMIT])
+                else:
+                    candidates.update(rows)
+            if len(common) > 1:
+                counts = Counter(itertools.chain.from_iterable(common))
+                shared = [r for r, n in counts.items() if n > 1]
+                if len(shared) > SIMILARITY_TOP:
+                    shared = heapq.nlargest(SIMILARITY_TOP, shared, key=counts.__getitem__)
+                candidates.update(shared)
+            if not candidates and common:
+                candidates = min(common, key=len)[:SIMILARITY_TOP]
+            partner = seen[key] = -max(
+                ((sum(a == codes[r] != MISSING for a, codes in zip(key, other_cols)), -r) for r in candidates),
+                default=(0, -MISSING))[1]
+        partners[pos] = partner
+    if progress is not None:
+        progress.advance(len(statuses) % PROGRESS_STEP)
+    return partners
+
+def cell_differences(rows_main, rows_other, pairs, partners, normalizer=None):
+    # Per main row, the mapped column indices whose value differs from the
+    # partner row's under the comparison's normalization.
+    normalizer = normalizer or LEGACY_NORMALIZER
+    key_of = str if normalizer.legacy else normalizer.key
+    differences = []
+    for row, partner in zip(rows_main, partners):
+        if partner == MISSING:
+            differences.append(())
+            continue
+        other = rows_other[partner]
+        differences.append(tuple(
+            i1 for i1, i2 in pairs
+            if i1 < len(row) and (i2 >= len(other) or key_of(row[i1]) != key_of(other[i2]))
+        ))
+    return differences
+
+class ComparisonResult:
+    # row_info items are (row, status) pairs, followed by one value per
+    # extra_headers column (partner row number, similarity score) and, when
+    # rows were paired, the tuple of mapped columns that differ from the
+    # partner. layout describes that shape to the writers.
+    def __init__(self, data1, data2, mapping, statuses_A, statuses_B, scores_A=None, scores_B=None,
+                 partners_A=None, partners_B=None, normalizer=None):
+        self.mapping = dict(mapping)
+        self.reverse_mapping = {v: k for k, v in mapping.items()}
+        self.details = {}
+        extra_headers = []
+        columns_A = [data1[1:], statuses_A]
+        columns_B = [data2[1:], statuses_B]
+        if partners_A is not None:
+            self.details.update(partners_A=partners_A, partners_B=partners_B)
+            extra_headers.append("Partner Row")
+            columns_A.append([None if p == MISSING else p + 2 for p in partners_A])
+            columns_B.append([None if p == MISSING else p + 2 for p in partners_B])
+        if scores_A is not None:
+            self.details.update(scores_A=scores_A, scores_B=scores_B)
+            extra_headers.append("Similarity")
+            columns_A.append([round(s, 3) for s in scores_A])
+            columns_B.append([round(s, 3) for s in scores_B])
+        if partners_A is not None:
+            columns_A.append(cell_differences(data1[1:], data2[1:], list(self.mapping.items()), partners_A, normalizer))
+            columns_B.append(cell_differences(data2[1:], data1[1:], list(self.reverse_mapping.items()), partners_B, normalizer))
+        self.layout = (tuple(extra_headers), partners_A is not None)
+        self.row_info_A = list(zip(*columns_A))
+        self.row_info_B = list(zip(*columns_B))
+
+    def sort_by_match(self):
+        self.row_info_A.sort(key=lambda x: STATUS_RANK.get(x[1], 99))
+        self.row_info_B.sort(key=lambda x: STATUS_RANK.get(x[1], 99))
+
+    def rows_with_status(self, status, file1=True):
+        row_info = self.row_info_A if file1 else self.row_info_B
+        return [row for row in row_info if row[1] == status]
+
+    def counts(self, file1=True):
+        d = {status: 0 for status in MATCH_TYPES}
+        for row in (self.row_info_A if file1 else self.row_info_B):
+            if row[1] in d: d[row[1]] += 1
+        return d
+
+    def status_codes(self, file1=True):
+        return bytes(STATUS_ORDER[row[1]] for row in (self.row_info_A if file1 else self.row_info_B))
+
+def compare_sheets(data1, data2, mapping, progress=None, normalizer=None, similarity=None, pair_rows=False):
+    # similarity is the threshold (0-1] of the Similar Match pass, or None;
+    # pair_rows adds each row's best partner and its differing cells.
+    dictionary = ValueDictionary(normalizer)
+    sheet1 = ColumnarSheet(data1, dictionary)
+    sheet2 = ColumnarSheet(data2, dictionary)
+    reverse_mapping = {v: k for k, v in mapping.items()}
+    if progress is not None:
+        progress.start("Matching", len(sheet1.rows) + len(sheet2.rows))
+    statuses_A = classify_rows(sheet1, sheet2, list(mapping.items()), progress)
+    statuses_B = classify_rows(sheet2, sheet1, list(reverse_mapping.items()), progress)
+    scores_A = scores_B = similar_A = similar_B = None
+    if similarity:
+        if progress is not None:
+            progress.start("Similarity", sum(s != "Full Match" for s in itertools.chain(statuses_A, statuses_B)))
+        scores_A, similar_A = similarity_scores(sheet1, sheet2, list(mapping.items()), statuses_A, similarity, progress)
+        scores_B, similar_B = similarity_scores(sheet2, sheet1, list(reverse_mapping.items()), statuses_B, similarity, progress)
+    partners_A = partners_B = None
+    if pair_rows:
+        if progress is not None:
+            progress.start("Pairing", len(sheet1.rows) + len(sheet2.rows))
+        partners_A = best_partners(sheet1, sheet2, list(mapping.items()), statuses_A, similar_A, progress)
+        partners_B = best_partners(sheet2, sheet1, list(reverse_mapping.items()), statuses_B, similar_B, progress)
+    return ComparisonResult(data1, data2, mapping, statuses_A, statuses_B, scores_A, scores_B,
+                            partners_A, partners_B, normalizer)
+
+class MatchIndex:
+    # Match state of one comparison setup, kept between runs so a re-compare
+    # only re-evaluates what changed. Per side it holds each row's normalized
+    # mapped values (its fingerprint) and status, plus, for each direction,
+    # counts of the other side's full keys and per-column values. A row's
+    # status only depends on which of its keys and values are present on the
+    # other side, so after an edit only the added rows and the rows holding a
+    # key or value that appeared or disappeared there are looked at again.
+    # Every row of a side must have the same length (see supports()).
+    def __init__(self, mapping, widths, normalizer=None):
+        reverse_mapping = {v: k for k, v in mapping.items()}
+        width1, width2 = widths
+        self.widths = tuple(widths)
+        self.normalizer = normalizer or LEGACY_NORMALIZER
+        pairs = (
+            [(i1, i2) for i1, i2 in mapping.items() if i1 < width1 and i2 < width2],
+            [(i2, i1) for i2, i1 in reverse_mapping.items() if i2 < width2 and i1 < width1],
+        )
+        # cols[side]: the columns of that side any pair reads; slots[d]: for
+        # direction d (side d against the other side), where each pair's main
+        # and other column sit in those fingerprints.
+        self.cols = (
+            sorted({a for a, _ in pairs[0]} | {a for _, a in pairs[1]}),
+            sorted({b for _, b in pairs[0]} | {b for b, _ in pairs[1]}),
+        )
+        self.slots = []
+        for d in (0, 1):
+            main_pos = {c: n for n, c in enumerate(self.cols[d])}
+            other_pos = {c: n for n, c in enumerate(self.cols[1 - d])}
+            self.slots.append(([main_pos[a] for a, _ in pairs[d]], [other_pos[b] for _, b in pairs[d]]))
+        self.pair_counts = (len(pairs[0]), len(pairs[1]))
+        self._clear()
+
+    def _clear(self):
+        self.rows = ([], [])
+        self.statuses = (bytearray(), bytearray())
+        self.full_counts = (Counter(), Counter())
+        self.value_counts = tuple([Counter() for _ in range(n)] for n in self.pair_counts)
+
+    @staticmethod
+    def supports(data1, data2):
+        return all(len({len(row) for row in data[1:]}) <= 1 for data in (data1, data2))
+
+    @staticmethod
+    def widths_of(data1, data2):
+        return tuple(len(data[1]) if len(data) > 1 else 0 for data in (data1, data2))
+
+    def _diff(self, side, data):
+        # (fingerprints, their columns, old position or MISSING per row,
+        # added rows, removed old rows).
+        keys = self.normalizer.keys
+        columns = [list(keys([row[c] for row in data[1:]])) for c in self.cols[side]]
+        rows = list(zip(*columns)) if columns else [()] * (len(data) - 1)
+        old_rows = self.rows[side]
+        if rows == old_rows:
+            return rows, columns, range(len(rows)), [], []
+        # Rows still at their old position pair up directly (cells edited in
+        # place); the rest are matched to the unclaimed old rows by value.
+        if len(rows) == len(old_rows):
+            origin = [pos if row == old else MISSING for pos, (row, old) in enumerate(zip(rows, old_rows))]
+        else:
+            origin = [MISSING] * len(rows)
+        claimed = set(origin)
+        old_positions = {}
+        for pos, row in enumerate(old_rows):
+            if pos not in claimed:
+                old_positions.setdefault(row, []).append(pos)
+        for positions in old_positions.values():
+            positions.reverse()
+        added = []
+        for pos, row in enumerate(rows):
+            if origin[pos] == MISSING:
+                positions = old_positions.get(row)
+                if positions:
+                    origin[pos] = positions.pop()
+                else:
+                    added.append(pos)
+        removed = [pos for positions in old_positions.values() for pos in positions]
+        return rows, columns, origin, added, removed
+
+    def _count(self, d, removed_rows, added_rows):
+        # Moves direction d's counts of the other side from the removed rows
+        # to the added ones; returns the full keys and, per pair, the values
+        # whose presence flipped.
+        _, other_slots = self.slots[d]
+        full, values = self.full_counts[d], self.value_counts[d]
+        if not full and not removed_rows:
+            full.update(tuple(row[n] for n in other_slots) for row in added_rows)
+            for counts, n in zip(values, other_slots):
+                counts.update(row[n] for row in added_rows)
+            return set(full), [set(counts) for counts in values]
+        was_full, was_value = {}, [{} for _ in values]
+        for rows, step in ((removed_rows, -1), (added_rows, 1)):
+            for row in rows:
+                key = tuple(row[n] for n in other_slots)
+                was_full.setdefault(key, key in full)
+                full[key] += step
+                if not full[key]:
+                    del full[key]
+                for counts, was, n in zip(values, was_value, other_slots):
+                    value = row[n]
+                    was.setdefault(value, value in counts)
+                    counts[value] += step
+                    if not counts[value]:
+                        del counts[value]
+        flipped_full = {k for k, was in was_full.items() if (k in full) != was}
+        flipped_values = [{v for v, was in w.items() if (v in counts) != was} for counts, w in zip(values, was_value)]
+        return flipped_full, flipped_values
+
+    def update(self, data1, data2, progress=None):
+        # Brings the index up to date with the current sheets and returns
+        # (statuses_A, statuses_B, number of rows re-evaluated). The counts
+        # change before the rows and statuses do, so a run stopped part way
+        # (Cancelled included) empties the index and the next run rebuilds it.
+        try:
+            return self._update(data1, data2, progress)
+        except BaseException:
+            self._clear()
+            raise
+
+    def _update(self, data1, data2, progress):
+        changes = [self._diff(0, data1), self._diff(1, data2)]
+        full_code, partial_code, none_code = (STATUS_ORDER[s] for s in ("Full Match", "Partial Match", "No Match"))
+        pending_rows = []
+        for d in (0, 1):
+            other_rows, _, _, other_added, other_removed = changes[1 - d]
+            old_other = self.rows[1 - d]
+            flipped_full, flipped_values = self._count(
+                d, [old_other[pos] for pos in other_removed], [other_rows[pos] for pos in other_added])
+            rows, columns, _, added, _ = changes[d]
+            main_slots, _ = self.slots[d]
+            pending = set(added)
+            if len(pending) == len(rows):
+                pending_rows.append(range(len(rows)))
+                continue
+            for n, flipped in zip(main_slots, flipped_values):
+                if flipped:
+                    pending.update(pos for pos, value in enumerate(columns[n]) if value in flipped)
+            if flipped_full and main_slots:
+                first = {key[0] for key in flipped_full}
+                pending.update(pos for pos, value in enumerate(columns[main_slots[0]])
+                               if value in first and tuple(rows[pos][n] for n in main_slots) in flipped_full)
+            pending_rows.append(sorted(pending))
+        if progress is not None:
+            progress.start("Matching", sum(map(len, pending_rows)))
+        statuses = []
+        for d in (0, 1):
+            rows, _, origin, _, _ = changes[d]
+            main_slots, _ = self.slots[d]
+            full, values = self.full_counts[d], self.value_counts[d]
+            old_statuses = self.statuses[d]
+            new_statuses = bytearray(none_code if o == MISSING else old_statuses[o] for o in origin)
+            for pos in tracked(pending_rows[d], progress):
+                row = rows[pos]
+                if main_slots and tuple(row[n] for n in main_slots) in full:
+                    new_statuses[pos] = full_code
+                elif any(row[n] in counts for n, counts in zip(main_slots, values)):
+                    new_statuses[pos] = partial_code
+                else:
+                    new_statuses[pos] = none_code
+            statuses.append(new_statuses)
+        self.rows = (changes[0][0], changes[1][0])
+        self.statuses = tuple(statuses)
+        return statuses[0], statuses[1], sum(map(len, pending_rows))
+
+class PickledLRU:
+    # LRU of the latest max_entries values. With a directory, every put also
+    # pickles (key, value) there under a hash of the key and keeps only the
+    # latest max_entries files, so a later session can reuse them; the
+    # stored key guards against stale files.
+    def __init__(self, max_entries, directory=None):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.entries = OrderedDict()
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode("utf-8")).hexdigest() + ".pkl")
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                stored_key, value = pickle.load(f)
+        except Exception:
+            return None
+        if stored_key != key:
+            return None
+        self._remember(key, value)
+        return value
+
+    def put(self, key, value):
+        self._remember(key, value)
+        if not self.directory:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._path(key), "wb") as f:
+                pickle.dump((key, value), f, pickle.HIGHEST_PROTOCOL)
+            self._prune_disk()
+        except OSError:
+            pass
+
+    def _remember(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _prune_disk(self):
+        files = [os.path.join(self.directory, f) for f in os.listdir(self.directory) if f.endswith(".pkl")]
+        files.sort(key=os.path.getmtime)
+        for path in files[:-self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+class MatchIndexStore(PickledLRU):
+    # MatchIndex per comparison setup (paths, sheets, columns, mapping and
+    # normalization, but not the file contents). The app only gives it a
+    # directory when result_cache_on_disk is set.
+    def __init__(self, max_entries=2, directory=None):
+        super().__init__(max_entries, directory)
+
+def compare_incremental(data1, data2, mapping, index=None, normalizer=None, progress=None):
+    # Same statuses as compare_sheets() for sheets MatchIndex.supports(),
+    # reusing index (from an earlier run of the same setup) when its column
+    # layout still fits. Returns (result, index, rows re-evaluated).
+    widths = MatchIndex.widths_of(data1, data2)
+    if index is None or index.widths != widths:
+        index = MatchIndex(mapping, widths, normalizer)
+    statuses_A, statuses_B, rechecked = index.update(data1, data2, progress)
+    result = ComparisonResult(data1, data2, mapping,
+                              [STATUS_LABELS[c] for c in statuses_A], [STATUS_LABELS[c] for c in statuses_B],
+                              normalizer=normalizer)
+    return result, index, rechecked
+
+class ReferenceIndex:
+    # One sheet encoded once and compared against any number of others, as
+    # in batch runs. All its columns are encoded up front and each other
+    # sheet gets a copy of the dictionary, so the reference's codes, keys and
+    # value sets stay valid and are reused from one comparison to the next.
+    def __init__(self, data, normalizer=None):
+        self.data = data
+        self.normalizer = normalizer or LEGACY_NORMALIZER
+        self.dictionary = ValueDictionary(self.normalizer)
+        self.sheet = ColumnarSheet(data, self.dictionary)
+        for col in range(max(self.sheet.groups, default=0)):
+            self.sheet.codes(col)
+        self._sketches = None
+
+    def sketches(self):
+        # Column sketches of a sample of the rows, made once per process
+        # since sketch hashes are not comparable across processes.
+        if self._sketches is None:
+            width = len(self.data[0]) if self.data else 0
+            self._sketches = column_sketches(spread_sample(self.data[1:], sample_size(width)), width)
+        return self._sketches
+
+    def compare(self, data, mapping, progress=None):
+        # compare_sheets(self.data, data, mapping) without similarity or
+        # pairing.
+        other = ColumnarSheet(data, self.dictionary.copy())
+        reverse_mapping = {v: k for k, v in mapping.items()}
+        if progress is not None:
+            progress.start("Matching", len(self.sheet.rows) + len(other.rows))
+        statuses_A = classify_rows(self.sheet, other, list(mapping.items()), progress)
+        statuses_B = classify_rows(other, self.sheet, list(reverse_mapping.items()), progress)
+        return ComparisonResult(self.data, data, mapping, statuses_A, statuses_B, normalizer=self.normalizer)
+
+def file_fingerprint(path):
+    st = os.stat(path)
+    return (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+def comparison_key(path1, sheet1, include1, path2, sheet2, include2, mapping, normalizer=None, similarity=None,
+                   pair_rows=False):
+    try:
+        return (
+            file_fingerprint(path1), sheet1, tuple(include1),
+            file_fingerprint(path2), sheet2, tuple(include2),
+            tuple(sorted(mapping.items())),
+            (normalizer or LEGACY_NORMALIZER).options(),
+            similarity,
+            pair_rows,
+        )
+    except OSError:
+        return None
+
+class ResultCache(PickledLRU):
+    # Per-row status codes (one byte per row, in sheet order) plus the
+    # result's details (similarity scores, partner rows) keyed by
+    # comparison_key(); a None key (a file that could not be read) is never
+    # cached.
+    def __init__(self, max_entries=8, directory=None):
+        super().__init__(max_entries, directory)
+
+    def get(self, key):
+        return None if key is None else super().get(key)
+
+    def put(self, key, statuses_A, statuses_B, details=None):
+        if key is not None:
+            super().put(key, (bytes(statuses_A), bytes(statuses_B), dict(details or {})))
+
+class FastReaderUnsupported(Exception):
+    pass
+
+class _StopParsing(Exception):
+    pass
+
+_NS = SHEET_MAIN_NS + "}"
+_ROW, _CELL, _VALUE, _FORMULA, _INLINE, _TEXT, _PHONETIC, _DIMENSION, _SHEET_DATA = (
+    _NS + tag for tag in ("row", "c", "v", "f", "is", "t", "rPh", "dimension", "sheetData"))
+
+class _SheetHandler:
+    # expat callbacks for one worksheet part. Finished rows collect in
+    # self.rows as (row number, [(column, value), ...]) until drained.
+    # Conversions mirror openpyxl's WorkSheetParser.parse_cell. With wanted
+    # (a set of 1-based column numbers) other cells are passed over before
+    # their text is gathered or converted, formulas included.
+    def __init__(self, strings, date_formats, timedelta_formats, epoch, wanted=None):
+        self.strings = strings
+        self.date_formats = date_formats
+        self.timedelta_formats = timedelta_formats
+        self.epoch = epoch
+        self.rows = []
+        self.cells = None
+        self.row_idx = 0
+        self.col = 0
+        self.kind = "n"
+        self.style = None
+        self.value = None
+        self.text = None
+        self.inline = None
+        self.phonetic = False
+        self.columns = {}
+        self.wanted = wanted
+        self.skip = False
+
+    def start(self, name, attrs):
+        if name == _CELL:
+            ref = attrs.get("r")
+            if ref:
+                letters = ref.rstrip("0123456789")
+                col = self.columns.get(letters)
+                if col is None:
+                    col = self.columns[letters] = column_index_from_string(letters)
+                self.col = col
+            else:
+                self.col += 1
+            self.skip = self.wanted is not None and self.col not in self.wanted
+            self.kind = attrs.get("t", "n")
+            self.style = attrs.get("s")
+            self.value = None
+        elif name == _ROW:
+            r = attrs.get("r")
+            if r is None:
+                self.row_idx += 1
+            else:
+                try:
+                    self.row_idx = int(r)
+                except ValueError:
+                    raise FastReaderUnsupported("row number " + r)
+            self.cells = []
+            self.col = 0
+        elif self.skip:
+            pass
+        elif name == _VALUE:
+            if self.value is None and self.kind != "inlineStr":
+                self.text = []
+        elif name == _TEXT:
+            if self.inline is not None and not self.phonetic:
+                self.text = []
+        elif name == _INLINE:
+            if self.kind == "inlineStr" and self.inline is None:
+                self.inline = []
+        elif name == _PHONETIC:
+            self.phonetic = True
+        elif name == _FORMULA:
+            # openpyxl returns the formula text (with shared formulas
+            # translated) instead of the cached value.
+            raise FastReaderUnsupported("formula")
+
+    def chars(self, data):
+        if self.text is not None:
+            self.text.append(data)
+
+    def end(self, name):
+        if name == _CELL:
+            if self.skip:
+                return
+            value = self.value
+            kind = self.kind
+            if value is not None:
+                if kind == "n":
+                    value = float(value) if ("." in value or "E" in value or "e" in value) else int(value)
+                    style = self.style
+                    if style and int(style) in self.date_formats:
+                        try:
+                            value = from_excel(value, self.epoch, timedelta=int(style) in self.timedelta_formats)
+                        except (OverflowError, ValueError):
+                            raise FastReaderUnsupported("date out of range")
+                elif kind == "s":
+                    value = self.strings[int(value)]
+                elif kind == "b":
+                    value = bool(int(value))
+                elif kind == "d":
+                    value = from_ISO8601(value)
+            elif self.inline is not None:
+                value = "".join(self.inline)
+            self.inline = None
+            self.cells.append((self.col, value))
+        elif name == _VALUE:
+            if self.text is not None:
+                self.value = "".join(self.text) or None
+                self.text = None
+        elif name == _TEXT:
+            if self.text is not None:
+                self.inline.append("".join(self.text))
+                self.text = None
+        elif name == _PHONETIC:
+            self.phonetic = False
+        elif name == _ROW:
+            self.rows.append((self.row_idx, self.cells))
+            self.cells = None
+
+def _new_parser():
+    parser = expat.ParserCreate(namespace_separator="}")
+    parser.buffer_text = True
+    return parser
+
+class XlsxReader:
+    # Streams cell values straight out of the worksheet XML with expat,
+    # without the per-cell objects of openpyxl's read-only mode or its
+    # dimension scan of every sheet on open. Sheet paths, shared strings,
+    # date styles and the epoch come from openpyxl's own workbook reader,
+    # so rows() matches iter_rows(values_only=True); anything it does not
+    # handle raises FastReaderUnsupported.
+    def __init__(self, path):
+        reader = ExcelReader(path, read_only=True)
+        try:
+            reader.read_manifest()
+            reader.read_strings()
+            reader.read_workbook()
+            apply_stylesheet(reader.archive, reader.wb)
+        except Exception:
+            reader.archive.close()
+            raise
+        self.archive = reader.archive
+        self.strings = reader.shared_strings
+        wb = reader.wb
+        self.date_formats = wb._date_formats
+        self.timedelta_formats = wb._timedelta_formats
+        self.epoch = wb.epoch
+        self.parts = {}
+        valid = set(reader.valid_files)
+        for sheet, rel in reader.parser.find_sheets():
+            if rel.target in valid:
+                self.parts[sheet.name] = None if "chartsheet" in rel.Type else rel.target
+        self.sheetnames = list(self.parts)
+
+    def close(self):
+        self.archive.close()
+
+    def _part(self, sheet):
+        if sheet not in self.parts:
+            raise KeyError("Worksheet {0} does not exist.".format(sheet))
+        if self.parts[sheet] is None:
+            raise FastReaderUnsupported("chartsheet")
+        return self.parts[sheet]
+
+    def dimension(self, sheet):
+        # (max column, max row) from the <dimension> record, or (None, None).
+        found = []
+        def start(name, attrs):
+            if name == _DIMENSION:
+                found.append(attrs.get("ref"))
+                raise _StopParsing()
+            if name == _SHEET_DATA:
+                raise _StopParsing()
+        parser = _new_parser()
+        parser.StartElementHandler = start
+        with self.archive.open(self._part(sheet)) as src:
+            try:
+                while True:
+                    data = src.read(1 << 14)
+                    parser.Parse(data, not data)
+                    if not data:
+                        break
+            except _StopParsing:
+                pass
+        if not found or not found[0]:
+            return None, None
+        try:
+            _, _, max_col, max_row = range_boundaries(found[0])
+        except (TypeError, ValueError):
+            raise FastReaderUnsupported("dimension " + found[0])
+        return max_col, max_row
+
+    def rows(self, sheet, columns=None):
+        # Same padding rules as openpyxl: missing rows come back as empty
+        # rows and every row is as wide as the dimension says, or as its
+        # last cell when the sheet has no dimension. With columns (0-based
+        # indices) each row holds just those cells, in that order, and the
+        # others are never converted; cells past the row's width are None.
+        max_col, max_row = self.dimension(sheet)
+        wanted = None
+        if columns is not None:
+            wanted = {i + 1 for i in columns if max_col is None or i < max_col}
+            empty_row = (None,) * len(columns)
+        else:
+            empty_row = (None,) * max_col if max_col is not None else ()
+        handler = _SheetHandler(self.strings, self.date_formats, self.timedelta_formats, self.epoch, wanted)
+        parser = _new_parser()
+        parser.StartElementHandler = handler.start
+        parser.EndElementHandler = handler.end
+        parser.CharacterDataHandler = handler.chars
+        counter = idx = 1
+        with self.archive.open(self._part(sheet)) as src:
+            done = False
+            while not done:
+                data = src.read(1 << 16)
+                parser.Parse(data, not data)
+                parsed, handler.rows = handler.rows, []
+                done = not data
+                for idx, cells in parsed:
+                    if max_row is not None and idx > max_row:
+                        done = True
+                        break
+                    for _ in range(counter, idx):
+                        counter += 1
+                        yield empty_row
+                    if counter <= idx:
+                        if columns is not None:
+                            if cells:
+                                values = dict(cells)
+                                yield tuple([values.get(i + 1) for i in columns])
+                            else:
+                                yield empty_row
+                        elif not cells and not max_col:
+                            yield ()
+                        else:
+                            width = max_col or cells[-1][0]
+                            values = [None] * width
+                            for col, value in cells:
+                                if col <= width:
+                                    values[col - 1] = value
+                            yield tuple(values)
+                        counter += 1
+        if max_row is not None and max_row < idx:
+            for _ in range(counter, max_row + 1):
+                yield empty_row
+
+class SheetReader:
+    # Read-only access to a workbook's sheets through XlsxReader when
+    # fast is set, falling back to openpyxl for files or sheets it cannot
+    # read. A fallback in the middle of a sheet resumes after the rows
+    # already produced.
+    def __init__(self, path, fast=True):
+        self.path = path
+        self.fast = None
+        self.wb = None
+        if fast:
+            try:
+                self.fast = XlsxReader(path)
+            except Exception:
+                self.fast = None
+        if self.fast is None:
+            self.wb = openpyxl.load_workbook(path, read_only=True)
+        self.sheetnames = self.fast.sheetnames if self.fast else list(self.wb.sheetnames)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.fast is not None:
+            self.fast.close()
+        if self.wb is not None:
+            self.wb.close()
+
+    def _workbook(self):
+        if self.wb is None:
+            self.wb = openpyxl.load_workbook(self.path, read_only=True)
+        return self.wb
+
+    def part_size(self, sheet):
+        # Uncompressed size of the sheet's XML, or None when unknown.
+        if self.fast is not None:
+            try:
+                return self.fast.archive.getinfo(self.fast._part(sheet)).file_size
+            except (KeyError, FastReaderUnsupported):
+                pass
+        return None
+
+    def max_row(self, sheet):
+        if self.fast is not None:
+            try:
+                return self.fast.dimension(sheet)[1]
+            except FastReaderUnsupported:
+                pass
+        return self._workbook()[sheet].max_row
+
+    def rows(self, sheet, columns=None):
+        # With columns, rows hold just those cells as in XlsxReader.rows().
+        done = 0
+        if self.fast is not None:
+            try:
+                for row in self.fast.rows(sheet, columns):
+                    yield row
+                    done += 1
+                return
+            except FastReaderUnsupported:
+                pass
+        rows = itertools.islice(self._workbook()[sheet].iter_rows(values_only=True), done, None)
+        if columns is None:
+            yield from rows
+            return
+        for row in rows:
+            width = len(row)
+            yield tuple([row[i] if i < width else None for i in columns])
+
+class SheetCache:
+    # Parsed sheets keyed by (path, size, mtime, sheet, columns), evicted least
+    # recently used first once the total cell count passes max_cells. Rows are
+    # shared between callers and must not be modified in place.
+    def __init__(self, max_cells=5000000, fast_reader=True):
+        self.max_cells = max_cells
+        self.fast_reader = fast_reader
+        self.cells = 0
+        self.entries = OrderedDict()
+        self.names = {}
+        self.headers = {}
+        self.row_counts = {}
+
+    def load(self, path, sheet=None, progress=None, columns=None):
+        # Returns (sheetnames, sheet actually read, rows); falls back to the
+        # first sheet when the requested one is missing. With columns, every
+        # row (header included) is cut down to those indices by the reader,
+        # which never converts the other cells; the full header row is then
+        # only remembered for header() when the sheet was read in full.
+        fingerprint = file_fingerprint(path)
+        columns = None if columns is None else tuple(columns)
+        names = self.names.get(fingerprint)
+        if names is not None:
+            chosen = sheet if sheet in names else names[0]
+            key = (fingerprint, chosen, columns)
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return names, chosen, self.entries[key][0]
+            full = self.entries.get((fingerprint, chosen, None))
+            if full is not None:
+                rows = [[row[i] for i in columns] for row in full[0]]
+                self._store(key, rows)
+                return names, chosen, rows
+        with SheetReader(path, self.fast_reader) as reader:
+            names = reader.sheetnames
+            chosen = sheet if sheet in names else names[0]
+            if progress is not None:
+                progress.start(f"Loading {chosen}", reader.max_row(chosen) or 0)
+            rows = [list(row) for row in tracked(reader.rows(chosen, columns), progress)]
+        self.names[fingerprint] = names
+        if columns is None:
+            self.headers[(fingerprint, chosen)] = list(rows[0]) if rows else []
+        self.row_counts[(fingerprint, chosen)] = max(0, len(rows) - 1)
+        self._store((fingerprint, chosen, columns), rows)
+        return names, chosen, rows
+
+    def sheet_info(self, path, sheet=None):
+        # (sheetnames, sheet actually read, header row, data row estimate)
+        # without reading past the first row. The estimate comes from the
+        # sheet's dimension record and is None when the file has none.
+        fingerprint = file_fingerprint(path)
+        names = self.names.get(fingerprint)
+        if names is not None:
+            chosen = sheet if sheet in names else names[0]
+            key = (fingerprint, chosen)
+            if key in self.headers:
+                return names, chosen, self.headers[key], self.row_counts.get(key)
+        with SheetReader(path, self.fast_reader) as reader:
+            names = reader.sheetnames
+            chosen = sheet if sheet in names else names[0]
+            it = reader.rows(chosen)
+            header = list(next(it, ()))
+            it.close()
+            max_row = reader.max_row(chosen)
+            rows = max(0, max_row - 1) if max_row else None
+        key = (fingerprint, chosen)
+        self.names[fingerprint] = names
+        self.headers[key] = header
+        self.row_counts[key] = rows
+        return names, chosen, header, rows
+
+    def sketches(self, path, sheet):
+        # column_sketches() of a sample of the sheet's data rows: spread over
+        # the whole sheet when it is cached in full, else its first rows.
+        width = len(self.header(path, sheet))
+        count = sample_size(width)
+        full = self.entries.get((file_fingerprint(path), sheet, None))
+        if full is not None:
+            sample = spread_sample(full[0][1:], count)
+        else:
+            with SheetReader(path, self.fast_reader) as reader:
+                rows = reader.rows(sheet)
+                next(rows, None)
+                sample = list(itertools.islice(rows, count))
+                rows.close()
+        return column_sketches(sample, width)
+
+    def extent(self, path, sheet):
+        # (header, data rows, exact) for memory estimates. Without a row
+        # count from a load or the dimension record, rows are guessed from
+        # the size of the sheet's XML.
+        names, chosen, header, rows = self.sheet_info(path, sheet)
+        if chosen != sheet:
+            raise KeyError("Worksheet %s does not exist." % sheet)
+        if rows is not None:
+            return header, rows, True
+        with SheetReader(path, self.fast_reader) as reader:
+            size = reader.part_size(sheet)
+        if size is None:
+            size = os.path.getsize(path) * 8
+        return header, int(size / (XML_BYTES_PER_CELL * max(1, len(header)))), False
+
+    def header(self, path, sheet):
+        names, chosen, header, _ = self.sheet_info(path, sheet)
+        if chosen != sheet:
+            raise KeyError("Worksheet %s does not exist." % sheet)
+        return header
+
+    def rows(self, path, sheet, progress=None, columns=None):
+        names, chosen, rows = self.load(path, sheet, progress, columns)
+        if chosen != sheet:
+            raise KeyError("Worksheet %s does not exist." % sheet)
+        return rows
+
+    def _store(self, key, rows):
+        size = sum(len(row) for row in rows)
+        if size > self.max_cells:
+            return
+        if key in self.entries:
+            self.cells -= self.entries.pop(key)[1]
+        self.entries[key] = (rows, size)
+        self.cells += size
+        while self.cells > self.max_cells:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.cells -= evicted
+
+class SheetSource:
+    # Re-readable stream of the data rows of one sheet, projected to the
+    # included columns, for comparisons that must not hold the sheet in memory.
+    def __init__(self, path, sheet, columns, fast_reader=True):
+        self.path = path
+        self.sheet = sheet
+        self.columns = list(columns)
+        self.fast_reader = fast_reader
+
+    def rows(self):
+        with SheetReader(self.path, self.fast_reader) as reader:
+            rows = reader.rows(self.sheet, self.columns)
+            next(rows, None)
+            for row in rows:
+                yield list(row)
+
+class MemoryModel:
+    # Peak memory estimate of a comparison run from per-cell byte costs:
+    # loaded (parsed rows held in memory), compared (engine state per mapped
+    # cell) and output (a styled cell in a regular openpyxl workbook).
+    # calibrate() measures them with tracemalloc on a synthetic sheet pair.
+    DEFAULT_COSTS = {"loaded": 90, "compared": 120, "output": 600}
+    STREAMED_ROW_BYTES = 16
+
+    def __init__(self, costs=None):
+        self.costs = dict(self.DEFAULT_COSTS)
+        self.costs.update({k: v for k, v in (costs or {}).items() if k in self.DEFAULT_COSTS})
+
+    @classmethod
+    def calibrate(cls, opts, rows=1000, cols=6):
+        def value(r, c):
+            kind = c % 4
+            if kind == 0: return f"text {r}-{c}"
+            if kind == 1: return r * c + 0.5
+            if kind == 2: return r * 1000 + c
+            return datetime.datetime(2020, 1, 1) + datetime.timedelta(days=r % 3650, seconds=c)
+        cells = rows * cols
+        mapping = {c: c for c in range(cols)}
+        started = tracemalloc.is_tracing()
+        if not started:
+            tracemalloc.start()
+        try:
+            base = tracemalloc.get_traced_memory()[0]
+            header = [f"Column {c}" for c in range(cols)]
+            data1 = [header] + [[value(r, c) for c in range(cols)] for r in range(rows)]
+            data2 = [header] + [[value(r + rows // 2, c) for c in range(cols)] for r in range(rows)]
+            loaded = (tracemalloc.get_traced_memory()[0] - base) / (2 * cells)
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            result = compare_sheets(data1, data2, mapping)
+            compared = (tracemalloc.get_traced_memory()[1] - base) / (2 * cells)
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            wb = new_output_workbook()
+            write_output_sheet(wb.create_sheet("File1"), result.row_info_A, header, opts, mapping, True, False)
+            output = (tracemalloc.get_traced_memory()[1] - base) / (cells + rows)
+            del wb, result
+        finally:
+            if not started:
+                tracemalloc.stop()
+        return cls({"loaded": round(loaded), "compared": round(compared), "output": round(output)})
+
+    def estimate(self, cells, mapped_cells, rows, streaming=False, write_only=False, stream_memory=0):
+        # Bytes at peak for a run over cells loaded cells (both sheets, after
+        # projection) of which mapped_cells are compared, rows data rows in all.
+        costs = self.costs
+        if streaming:
+            total = stream_memory + rows * self.STREAMED_ROW_BYTES
         else:
-            matches = difflib.get_close_matches(h1_lower, headers2_lower, n=1, cutoff=0.8)
-            if matches and matches[0] in headers2_lower:
-                mapping[i] = headers2_lower.index(matches[0])
-    return mapping
+            total = cells * costs["loaded"] + mapped_cells * costs["compared"]
+        if not write_only:
+            total += (cells + rows) * costs["output"]
+        return int(total)
+
+def default_memory_budget():
+    # Half of the physical memory where the platform reports it.
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2
+    except (AttributeError, ValueError, OSError):
+        return 4 * 1024 ** 3
+
+class ExternalSorter:
+    # Buffers (key, side, row id) records and spills them as sorted runs to
+    # temporary files whenever the buffer passes its memory share; merged()
+    # k-way merges the runs back into one sorted stream.
+    def __init__(self, memory_limit):
+        self.memory_limit = memory_limit
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.runs = []
+
+    def add(self, record, size):
+        self.buffer.append(record)
+        self.buffer_bytes += size
+        if self.buffer_bytes >= self.memory_limit:
+            self.spill()
+
+    def spill(self):
+        if not self.buffer:
+            return
+        self.buffer.sort()
+        run = tempfile.TemporaryFile()
+        for i in range(0, len(self.buffer), SPILL_BLOCK):
+            pickle.dump(self.buffer[i:i + SPILL_BLOCK], run, pickle.HIGHEST_PROTOCOL)
+        run.seek(0)
+        self.runs.append(run)
+        self.buffer = []
+        self.buffer_bytes = 0
+
+    def merged(self):
+        if not self.runs:
+            self.buffer.sort()
+            return iter(self.buffer)
+        self.spill()
+        return heapq.merge(*[_read_run(run) for run in self.runs])
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.buffer = []
+
+def _read_run(run):
+    while True:
+        try:
+            block = pickle.load(run)
+        except EOFError:
+            return
+        yield from block
+
+def _record_size(key):
+    return 120 + sum(56 + len(v) for v in key)
+
+def _mark_merged(records, statuses_A, statuses_B, level, apply_A, apply_B):
+    # Records arrive sorted by (key, side, row id), so all File1 rows of a key
+    # are seen before its File2 rows; only the File1 ids of the current key
+    # have to be buffered.
+    current = None
+    pending = array("l")
+    matched = False
+    for key, side, row_id in records:
+        if key != current:
+            current, pending, matched = key, array("l"), False
+        if side == 0:
+            pending.append(row_id)
+            continue
+        if not pending:
+            continue
+        if not matched:
+            matched = True
+            if apply_A:
+                for p in pending:
+                    if statuses_A[p] > level: statuses_A[p] = level
+        if apply_B and statuses_B[row_id] > level:
+            statuses_B[row_id] = level
+
+def compare_external(rows1, rows2, mapping, width1, width2, memory_limit, progress=None, normalizer=None):
+    # Sort-merge variant of compare_sheets for sheets that do not fit in memory.
+    # Rows are streamed once; full keys and (column pair, value) entries are
+    # spilled to sorted runs and matched by merging. Only one status byte per
+    # row is kept.
+    normalizer = normalizer or LEGACY_NORMALIZER
+    key_of = str if normalizer.legacy else normalizer.key
+    reverse_mapping = {v: k for k, v in mapping.items()}
+    usable_A = [(i1, i2) for i1, i2 in mapping.items() if i1 < width1 and i2 < width2]
+    usable_B = [(i1, i2) for i2, i1 in reverse_mapping.items() if i1 < width1 and i2 < width2]
+    if usable_A == usable_B:
+        full_jobs = [(usable_A, True, True)] if usable_A else []
+    else:
+        full_jobs = [job for job in ((usable_A, True, False), (usable_B, False, True)) if job[0]]
+    column_pairs = sorted(set(usable_A) | set(usable_B))
+    applies = [((pair in usable_A), (pair in usable_B)) for pair in column_pairs]
+    share = max(1, memory_limit // (len(full_jobs) + 1))
+    full_sorters = [ExternalSorter(share) for _ in full_jobs]
+    partial_sorter = ExternalSorter(share)
+    counts = []
+    try:
+        for side, rows in enumerate((rows1, rows2)):
+            if progress is not None:
+                progress.start(f"Reading File{side + 1}")
+            row_id = -1
+            for row_id, row in enumerate(tracked(rows, progress)):
+                text = {}
+                for pair in column_pairs:
+                    col = pair[side]
+                    if col not in text: text[col] = key_of(row[col])
+                for (pairs, _, _), sorter in zip(full_jobs, full_sorters):
+                    key = tuple(text[pair[side]] for pair in pairs)
+                    sorter.add((key, side, row_id), _record_size(key))
+                for idx, pair in enumerate(column_pairs):
+                    value = text[pair[side]]
+                    partial_sorter.add(((idx, value), side, row_id), 140 + len(value))
+            counts.append(row_id + 1)
+        statuses_A = bytearray([STATUS_ORDER["No Match"]]) * counts[0]
+        statuses_B = bytearray([STATUS_ORDER["No Match"]]) * counts[1]
+        partial_level = STATUS_ORDER["Partial Match"]
+        if progress is not None:
+            progress.start("Merging")
+        for idx, group in itertools.groupby(tracked(partial_sorter.merged(), progress), key=lambda r: r[0][0]):
+            apply_A, apply_B = applies[idx]
+            _mark_merged(group, statuses_A, statuses_B, partial_level, apply_A, apply_B)
+        for (_, apply_A, apply_B), sorter in zip(full_jobs, full_sorters):
+            _mark_merged(tracked(sorter.merged(), progress), statuses_A, statuses_B,
+                         STATUS_ORDER["Full Match"], apply_A, apply_B)
+    finally:
+        for sorter in full_sorters + [partial_sorter]:
+            sorter.close()
+    return statuses_A, statuses_B
+
+class StreamedRows:
+    # (row, status) pairs re-read from a SheetSource on every iteration;
+    # order lists the status codes to emit, one pass over the sheet each.
+    def __init__(self, source, statuses, order=None):
+        self.source = source
+        self.statuses = statuses
+        self.order = order
+
+    def __len__(self):
+        if self.order is None:
+            return len(self.statuses)
+        return sum(self.statuses.count(code) for code in self.order)
+
+    def __iter__(self):
+        if self.order is None:
+            for row, code in zip(self.source.rows(), self.statuses):
+                yield row, STATUS_LABELS[code]
+            return
+        for wanted in self.order:
+            for row, code in zip(self.source.rows(), self.statuses):
+                if code == wanted:
+                    yield row, STATUS_LABELS[code]
+
+class StreamedComparisonResult(ComparisonResult):
+    def __init__(self, source1, source2, mapping, statuses_A, statuses_B):
+        self.mapping = dict(mapping)
+        self.reverse_mapping = {v: k for k, v in mapping.items()}
+        self.details = {}
+        self.layout = ((), False)
+        self.row_info_A = StreamedRows(source1, statuses_A)
+        self.row_info_B = StreamedRows(source2, statuses_B)
+
+    def sort_by_match(self):
+        # Each status in the order costs a pass over the sheet, so statuses
+        # no row has (Similar Match, always) are left out.
+        self.row_info_A = self._sorted(self.row_info_A)
+        self.row_info_B = self._sorted(self.row_info_B)
+
+    @staticmethod
+    def _sorted(rows):
+        order = tuple(STATUS_ORDER[status] for status in MATCH_TYPES if STATUS_ORDER[status] in rows.statuses)
+        return StreamedRows(rows.source, rows.statuses, order)
+
+    def rows_with_status(self, status, file1=True):
+        rows = self.row_info_A if file1 else self.row_info_B
+        return StreamedRows(rows.source, rows.statuses, (STATUS_ORDER[status],))
+
+    def counts(self, file1=True):
+        statuses = (self.row_info_A if file1 else self.row_info_B).statuses
+        return {status: statuses.count(STATUS_ORDER[status]) for status in MATCH_TYPES}
+
+    def status_codes(self, file1=True):
+        return bytes((self.row_info_A if file1 else self.row_info_B).statuses)
+
+def compare_streamed(source1, source2, mapping, memory_limit, progress=None, normalizer=None):
+    statuses_A, statuses_B = compare_external(
+        source1.rows(), source2.rows(), mapping, len(source1.columns), len(source2.columns),
+        memory_limit, progress, normalizer)
+    return StreamedComparisonResult(source1, source2, mapping, statuses_A, statuses_B)
+
+def write_output_sheet(ws, row_info, headers, opts, mapping, is_file1, export_mapped_only, progress=None,
+                       extra_headers=(), differences=False):
+    # row_info items are (row, status, *extra); the extra values go in
+    # extra_headers columns after MatchType. With differences, the last item
+    # is the tuple of row indices whose cells get the difference highlight.
+    styles = build_style_table(ws.parent, opts)
+
+    mapped_cols = []
+    if export_mapped_only:
+        if mapping:
+            if is_file1:
+                mapped_cols = [k for k, _ in sorted(mapping.items()) if k < len(headers)]
+            else:
+                mapped_cols = [v for _, v in sorted(mapping.items()) if v < len(headers)]
+        if not mapped_cols:
+            mapped_cols = list(range(len(headers)))
+    else:
+        mapped_cols = list(range(len(headers)))
+
+    if ws.parent.write_only:
+        write_streaming_sheet(ws, row_info, headers, mapped_cols, opts, styles, progress, extra_headers, differences)
+        return
+
+    header_values = [headers[i] for i in mapped_cols] + ["MatchType"] + list(extra_headers)
+    widths = ColumnWidths(len(header_values), opts["autofit_sample_rows"])
+    widths.add(header_values)
+    for col_idx, value in enumerate(header_values, 1):
+        cell = ws.cell(row=1, column=col_idx)
+        cell.style = styles["header"]
+        cell.value = value
+    ws.row_dimensions[1].height = opts["header_height"]
+
+    ws.freeze_panes = ws['A2']
+    max_row = max(2, len(row_info) + 1)
+    ws.auto_filter.ref = f"A1:{openpyxl.utils.get_column_letter(len(header_values))}{max_row}"
+
+    status_col = len(mapped_cols) + 1
+    diff_style = styles["difference"]
+    for idx, (row_main, status, *extra) in enumerate(tracked(row_info, progress), start=2):
+        body_style, status_style = styles.get(status, styles["No Match"])
+        differing = extra.pop() if differences else ()
+        values = [row_main[i] if i < len(row_main) else "" for i in mapped_cols]
+        values.append(status)
+        values.extend(extra)
+        widths.add(values)
+        for col_idx, value in enumerate(values[:status_col - 1], 1):
+            cell = ws.cell(row=idx, column=col_idx)
+            cell.style = diff_style if differing and mapped_cols[col_idx - 1] in differing else body_style
+            cell.value = value
+        for col_idx, value in enumerate(values[status_col - 1:], status_col):
+            cell = ws.cell(row=idx, column=col_idx)
+            cell.style = status_style
+            cell.value = value
+        ws.row_dimensions[idx].height = opts["body_height"]
+    with timed(progress, "Autofit", len(row_info)):
+        autofit_columns(ws, opts["padding"], widths.lengths)
+
+def write_streaming_sheet(ws, row_info, headers, mapped_cols, opts, styles, progress=None, extra_headers=(),
+                          differences=False):
+    # Write-only counterpart of write_output_sheet: cells are created
+    # pre-styled and appended row by row, so memory does not grow with the
+    # row count. Column widths must be known before the first row is
+    # written, so they are measured up front, over the sampled rows only
+    # when autofit sampling is on.
+    from openpyxl.cell import WriteOnlyCell
+    header_values = [headers[i] for i in mapped_cols] + ["MatchType"] + list(extra_headers)
+    sample_rows = opts["autofit_sample_rows"]
+    widths = ColumnWidths(len(header_values), sample_rows)
+    widths.add(header_values)
+    measured = itertools.islice(row_info, sample_rows) if sample_rows else row_info
+    with timed(progress, "Autofit", len(row_info)):
+        for row_main, status, *extra in measured:
+            if differences: extra.pop()
+            widths.add([row_main[i] if i < len(row_main) else "" for i in mapped_cols] + [status] + extra)
+        autofit_columns(ws, opts["padding"], widths.lengths)
+
+    ws.freeze_panes = "A2"
+    max_row = max(2, len(row_info) + 1)
+    ws.auto_filter.ref = f"A1:{openpyxl.utils.get_column_letter(len(header_values))}{max_row}"
+
+    def styled(value, style):
+        cell = WriteOnlyCell(ws)
+        cell.style = style
+        cell.value = value
+        return cell
+
+    ws.row_dimensions[1].height = opts["header_height"]
+    ws.append([styled(v, styles["header"]) for v in header_values])
+    del ws.row_dimensions[1]
+    diff_style = styles["difference"]
+    for idx, (row_main, status, *extra) in enumerate(tracked(row_info, progress), start=2):
+        body_style, status_style = styles.get(status, styles["No Match"])
+        differing = extra.pop() if differences else ()
+        cells = [
+            styled(row_main[header_index] if header_index < len(row_main) else "",
+                   diff_style if differing and header_index in differing else body_style)
+            for header_index in mapped_cols
+        ]
+        cells.append(styled(status, status_style))
+        cells.extend(styled(value, status_style) for value in extra)
+        ws.row_dimensions[idx].height = opts["body_height"]
+        ws.append(cells)
+        del ws.row_dimensions[idx]
+
+def write_summary_sheet(ws, headers, rows, opts):
+    # Plain table with the output's header style, first in the workbook.
+    from openpyxl.cell import WriteOnlyCell
+    header_style = build_style_table(ws.parent, opts)["header"]
+    widths = ColumnWidths(len(headers))
+    widths.add(headers)
+    for row in rows:
+        widths.add(row)
+    autofit_columns(ws, opts["padding"], widths.lengths)
+    if ws.parent.write_only:
+        cells = []
+        for value in headers:
+            cell = WriteOnlyCell(ws, value)
+            cell.style = header_style
+            cells.append(cell)
+        ws.append(cells)
+    else:
+        ws.append(list(headers))
+        for cell in ws[1]:
+            cell.style = header_style
+    for row in rows:
+        ws.append(list(row))
+
+def write_workbook(path, sheets, opts, export_mapped_only, write_only=False, progress=None, summary=None):
+    # summary, when given, is (headers, rows) for a Summary sheet put first.
+    wb = new_output_workbook(write_only)
+    if summary is not None:
+        write_summary_sheet(wb.create_sheet("Summary"), summary[0], summary[1], opts)
+    for title, row_info, headers, mapping, is_file1, (extra_headers, differences) in sheets:
+        ws = wb.create_sheet(title)
+        write_output_sheet(ws, row_info, headers, opts, mapping, is_file1, export_mapped_only, progress,
+                           extra_headers, differences)
+    if progress is not None: progress.check()
+    with timed(progress, "Saving", sum(len(sheet[1]) for sheet in sheets)):
+        wb.save(path)
+    return path
+
+def export_workbooks(jobs, opts, export_mapped_only, write_only=False, workers=1, on_saved=None, progress=None):
+    # jobs are (path, sheets) pairs that all read from one comparison result.
+    # With several workers each workbook is written and saved in its own
+    # process, largest first; on_saved(path) runs as each file completes.
+    # Pool workers cannot report rows, so progress advances per workbook and
+    # a cancel lets workbooks already being written finish.
+    sized = sorted(((sum(len(sheet[1]) for sheet in sheets), path, sheets) for path, sheets in jobs),
+                   key=lambda job: -job[0])
+    if progress is not None:
+        progress.start("Writing", sum(size for size, _, _ in sized))
+    if workers <= 1 or len(sized) <= 1:
+        for _, path, sheets in sized:
+            write_workbook(path, sheets, opts, export_mapped_only, write_only, progress)
+            if on_saved: on_saved(path)
+        return
+    with ProcessPoolExecutor(max_workers=min(workers, len(sized))) as pool:
+        pending = {
+            pool.submit(write_workbook, path, sheets, opts, export_mapped_only, write_only): size
+            for size, path, sheets in sized
+        }
+        try:
+            while pending:
+                done, _ = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                for future in done:
+                    size = pending.pop(future)
+                    path = future.result()
+                    if progress is not None: progress.advance(size)
+                    if on_saved: on_saved(path)
+                if progress is not None: progress.check()
+        except Cancelled:
+            for future in pending:
+                future.cancel()
+            raise
+
+def read_pairing_table(path):
+    # CSV rows of "sheet in file 1, sheet in file 2[, mapping profile]";
+    # blank rows and rows starting with # are skipped. Relative profile
+    # paths are taken from the table's folder.
+    pairs = []
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        for row in csv.reader(f):
+            row = [cell.strip() for cell in row]
+            if not row or not row[0] or row[0].startswith("#") or len(row) < 2:
+                continue
+            profile = os.path.join(base, row[2]) if len(row) > 2 and row[2] else None
+            pairs.append((row[0], row[1], profile))
+    return pairs
+
+def pair_sheets(names1, names2, table=None):
+    # Returns ([(sheet1, sheet2, profile path or None)], unpaired) where
+    # unpaired lists (file, sheet) for sheets of either file left out. With
+    # a pairing table its rows are used as given; otherwise sheets pair by
+    # exact name, then by name ignoring case and surrounding spaces.
+    if table is not None:
+        pairs = list(table)
+        used1 = {p[0] for p in pairs}
+        used2 = {p[1] for p in pairs}
+    else:
+        pairs = [(name, name, None) for name in names1 if name in names2]
+        used1 = used2 = {p[0] for p in pairs}
+        loose = {}
+        for name in names2:
+            if name not in used2:
+                loose.setdefault(name.strip().casefold(), name)
+        for name in names1:
+            match = loose.pop(name.strip().casefold(), None) if name not in used1 else None
+            if match is not None:
+                pairs.append((name, match, None))
+        used1 = {p[0] for p in pairs}
+        used2 = {p[1] for p in pairs}
+    unpaired = [(1, name) for name in names1 if name not in used1] + [(2, name) for name in names2 if name not in used2]
+    return pairs, unpaired
+
+def read_mapping_profile(path):
+    # (headers1, headers2, mapping, include1, include2) from a profile saved
+    # by the mapping dialog.
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    mapping = {int(k): int(v) for k, v in data.get("mapping", {}).items()}
+    return data.get("headers1", []), data.get("headers2", []), mapping, data.get("include1", []), data.get("include2", [])
+
+def find_mapping_profile(headers1, headers2, directory):
+    # The first profile in directory saved for exactly these headers.
+    if not directory or not os.path.isdir(directory):
+        return None
+    for name in sorted(os.listdir(directory)):
+        if not name.lower().endswith(".json"):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            profile = read_mapping_profile(path)
+        except (OSError, ValueError, AttributeError, TypeError):
+            continue
+        if [str(h) for h in profile[0]] == [str(h) for h in headers1] and \
+                [str(h) for h in profile[1]] == [str(h) for h in headers2]:
+            return path
+    return None
+
+def output_sheet_title(name, suffix, taken):
+    # Unique worksheet title within Excel's 31 characters.
+    title = f"{name[:31 - len(suffix)]}{suffix}"
+    n = 2
+    while title.lower() in taken:
+        tail = f"~{n}{suffix}"
+        title = f"{name[:31 - len(tail)]}{tail}"
+        n += 1
+    taken.add(title.lower())
+    return title
+
+def workbook_headers(path, fast_reader=True):
+    # (sheetnames, {sheet: header row}) reading only the first row of each
+    # sheet through one open reader.
+    with SheetReader(path, fast_reader) as reader:
+        headers = {}
+        for sheet in reader.sheetnames:
+            try:
+                rows = reader.rows(sheet)
+                headers[sheet] = list(next(rows, ()))
+                rows.close()
+            except FastReaderUnsupported:
+                headers[sheet] = []
+        return list(reader.sheetnames), headers
+
+def compare_sheet_pair(job):
+    # One sheet pair of a workbook comparison; runs in a pool worker, so
+    # everything it needs comes in the job dict and everything the parent
+    # needs goes back in the result: the projected rows, status codes and
+    # result details, or the error.
+    try:
+        cache = SheetCache(max_cells=0, fast_reader=job["fast_reader"])
+        data1 = cache.rows(job["path1"], job["sheet1"], None, job["include1"])
+        data2 = cache.rows(job["path2"], job["sheet2"], None, job["include2"])
+        normalizer = Normalizer.from_settings(job["normalization"])
+        result = compare_sheets(data1, data2, job["mapping"], normalizer=normalizer,
+                                similarity=job["similarity"], pair_rows=job["pair_rows"])
+    except Cancelled:
+        raise
+    except Exception as e:
+        return {"error": str(e) or type(e).__name__}
+    return {"data1": data1, "data2": data2, "statuses_A": result.status_codes(file1=True),
+            "statuses_B": result.status_codes(file1=False), "details": result.details}
+
+def batch_mapping(reference_headers, include1, headers, current, sketches=None):
+    # (mapping, included columns, source) for one batch file: the current
+    # mapping when the file has the current File 2 headers, else mappings
+    # suggested against the reference's included columns. sketches() gives
+    # the (reference, file) column sketches for the suggestions.
+    current_headers, mapping, include2 = current
+    as_text = lambda values: [str(v) for v in values]
+    if current_headers and as_text(current_headers) == as_text(headers):
+        if len(include2) != len(headers): include2 = [True] * len(headers)
+        cols2 = [i for i, v in enumerate(include2) if v]
+        return {k: v for k, v in mapping.items() if k in include1 and v in cols2}, cols2, "Current mapping"
+    suggested = suggest_mappings(as_text(reference_headers), as_text(headers), *(sketches() if sketches else ()))
+    return {include1[i1]: i2 for i1, i2 in suggested.items()}, list(range(len(headers))), "Suggested"
+
+_batch_reference = None
+
+def init_batch_worker(reference_data, normalization):
+    # Pool initializer: each worker indexes the reference once.
+    global _batch_reference
+    _batch_reference = ReferenceIndex(reference_data, Normalizer.from_settings(normalization))
+
+def compare_batch_file(job, index=None, progress=None):
+    # Compares one file of a batch against the reference and writes its
+    # output workbook; returns the summary row as a dict.
+    index = index or _batch_reference
+    started = time.perf_counter()
+    summary = {"file": job["path"], "sheet": None, "output": None, "mapping": None, "error": ""}
+    try:
+        cache = SheetCache(max_cells=0, fast_reader=job["fast_reader"])
+        _, sheet, headers, _ = cache.sheet_info(job["path"], job["sheet"])
+        sketches = lambda: (index.sketches(), cache.sketches(job["path"], sheet))
+        mapping, include2, source = batch_mapping(job["reference_headers"], job["include1"], headers, job["current"],
+                                                  sketches)
+        summary.update(sheet=sheet, mapping=source)
+        data = cache.rows(job["path"], sheet, None, include2)
+        result = index.compare(data, mapping, progress)
+        if job["sort_by_match"]:
+            result.sort_by_match()
+        used_headers = [headers[i] for i in include2]
+        if progress is not None:
+            progress.start("Writing", len(result.row_info_A) + len(result.row_info_B))
+        write_workbook(job["output"], [
+            ("File1", result.row_info_A, job["reference_headers"], mapping, True, result.layout),
+            ("File2", result.row_info_B, used_headers, result.reverse_mapping, False, result.layout),
+        ], job["opts"], job["export_mapped_only"], job["write_only"], progress)
+        summary.update(output=job["output"], rows=len(result.row_info_B),
+                       counts=result.counts(file1=False), reference_counts=result.counts(file1=True))
+    except Cancelled:
+        raise
+    except Exception as e:
+        summary["error"] = str(e) or type(e).__name__
+    summary["seconds"] = round(time.perf_counter() - started, 3)
+    return summary
+
+def batch_files(directory, skip=()):
+    # Workbooks directly in directory, without Excel's ~$ lock files and
+    # the paths in skip.
+    skip = {os.path.normcase(os.path.abspath(p)) for p in skip}
+    files = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if (name.lower().endswith((".xlsx", ".xlsm")) and not name.startswith("~$") and os.path.isfile(path)
+                and os.path.normcase(os.path.abspath(path)) not in skip):
+            files.append(path)
+    return files
+
+def batch_output_name(path, taken):
+    # Name for one file's output: the file name without its extension, or
+    # with it when another file of the batch already took that name
+    # ("x.xlsx" and "x.xlsm").
+    stem, source_ext = os.path.splitext(os.path.basename(path))
+    name = stem
+    n = 1
+    while name.lower() in taken:
+        name = f"{stem}_{source_ext[1:]}" + (f"~{n}" if n > 1 else "")
+        n += 1
+    taken.add(name.lower())
+    return name
+
+def write_batch_summary(path, rows):
+    headers = (["File", "Sheet", "Rows"] + MATCH_TYPES + [f"Reference {mt}" for mt in MATCH_TYPES]
+               + ["Mapping", "Output", "Seconds", "Error"])
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(headers)
+        for row in rows:
+            counts = row.get("counts") or {}
+            reference_counts = row.get("reference_counts") or {}
+            writer.writerow([row["file"], row["sheet"], row.get("rows")]
+                            + [counts.get(mt) for mt in MATCH_TYPES]
+                            + [reference_counts.get(mt) for mt in MATCH_TYPES]
+                            + [row["mapping"], row["output"], row["seconds"], row["error"]])
 
 class MappingDialog(tk.Toplevel):
-    def __init__(self, master, headers1, headers2, mapdict, include1, include2):
+    def __init__(self, master, headers1, headers2, mapdict, include1, include2, sketcher=None):
+        # sketcher() returns the two sheets' column_sketches() for
+        # content-based suggestions; it is called on the first Suggest.
         super().__init__(master)
         self.title("Map Columns (File 1 → File 2)")
         self.geometry("950x600")
@@ -71,6 +2356,8 @@ class MappingDialog(tk.Toplevel):
         self.mapdict = dict(mapdict)
         self.include1 = list(include1)
         self.include2 = list(include2)
+        self.sketcher = sketcher
+        self.sketches = None
         self.result = None
         self.result_include1 = None
         self.result_include2 = None
@@ -172,7 +2459,17 @@ class MappingDialog(tk.Toplevel):
         h2 = [h for i, h in enumerate(self.headers2) if self.chk_vars2[i].get()]
         offset1 = [i for i, v in enumerate(self.chk_vars1) if v.get()]
         offset2 = [i for i, v in enumerate(self.chk_vars2) if v.get()]
-        smap = suggest_mappings(h1, h2)
+        if self.sketches is None and self.sketcher is not None:
+            try:
+                self.sketches = self.sketcher()
+            except Exception:
+                self.sketches = (None, None)
+            self.sketcher = None
+        sketches1, sketches2 = self.sketches or (None, None)
+        if sketches1 is not None and sketches2 is not None:
+            sketches1 = [sketches1[i] for i in offset1]
+            sketches2 = [sketches2[i] for i in offset2]
+        smap = suggest_mappings(h1, h2, sketches1, sketches2)
         new_mapdict = {}
         for i1, i2 in smap.items():
             new_mapdict[offset1[i1]] = offset2[i2]
@@ -222,14 +2519,10 @@ class MappingDialog(tk.Toplevel):
         fname = filedialog.askopenfilename(defaultextension=".json", filetypes=[("JSON files", "*.json")], title="Load Mapping Profile")
         if fname:
             try:
-                with open(fname, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                loaded_map = data.get("mapping", {})
-                loaded_map = {int(k): int(v) for k, v in loaded_map.items()}
-                self.mapdict = loaded_map
-                for i, v in enumerate(data.get("include1", [])):
+                _, _, self.mapdict, include1, include2 = read_mapping_profile(fname)
+                for i, v in enumerate(include1):
                     if i < len(self.chk_vars1): self.chk_vars1[i].set(v)
-                for i, v in enumerate(data.get("include2", [])):
+                for i, v in enumerate(include2):
                     if i < len(self.chk_vars2): self.chk_vars2[i].set(v)
                 self.update_mapping_view()
                 messagebox.showinfo("Loaded", "Mapping profile loaded.\n(check if headers match!)")
@@ -245,8 +2538,6 @@ class ExcelComparatorApp:
         self.theme_names = self.style.theme_names()
         self.file1 = ""
         self.file2 = ""
-        self.data1 = []
-        self.data2 = []
         self.headers1 = []
         self.headers2 = []
         self.sheetnames1 = []
@@ -259,17 +2550,40 @@ class ExcelComparatorApp:
         self.recent_files = self.settings.get("recent_files", [])
         self.recent_outputs = self.settings.get("recent_outputs", [])
         self.recent_filtered_outputs = self.settings.get("recent_filtered_outputs", [])
+        self.compare_workers = self.settings.get("compare_workers", 0)
+        self.export_workers = self.settings.get("export_workers", 0)
+        self.stream_memory_mb = self.settings.get("stream_memory_mb", 256)
+        self.job = None
+        self.job_queue = queue.Queue()
+        self.sheet_cache = SheetCache(self.settings.get("sheet_cache_cells", 5000000),
+                                      self.settings.get("fast_reader", True))
+        self.result_cache = ResultCache(
+            self.settings.get("result_cache_size", 8),
+            CACHE_DIR if self.settings.get("result_cache_on_disk", False) else None
+        )
+        self.match_indexes = MatchIndexStore(
+            directory=os.path.join(CACHE_DIR, "index") if self.settings.get("result_cache_on_disk", False) else None
+        )
+        self.run_log = self.settings.get("run_log", True)
+        self.memory_budget_mb = self.settings.get("memory_budget_mb")
+        self.memory_auto_switch = self.settings.get("memory_auto_switch", False)
         self.make_gui()
         self.apply_settings()
         self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
     def open_mapping(self):
-        self.reload_data1()
-        self.reload_data2()
+        if self.job_running():
+            return
+        self.reload_header1()
+        self.reload_header2()
         if not self.headers1 or not self.headers2:
             messagebox.showwarning("Mapping", "Load both files and sheets first.")
             return
-        dialog = MappingDialog(self.root, self.headers1, self.headers2, self.mapping, self.include1, self.include2)
+        path1, sheet1 = self.f1_var.get(), self.selected_sheet1.get()
+        path2, sheet2 = self.f2_var.get(), self.selected_sheet2.get()
+        sketcher = lambda: (self.sheet_cache.sketches(path1, sheet1), self.sheet_cache.sketches(path2, sheet2))
+        dialog = MappingDialog(self.root, self.headers1, self.headers2, self.mapping, self.include1, self.include2,
+                               sketcher)
         self.root.wait_window(dialog)
         if dialog.result is not None:
             self.mapping = mapping_str_to_int(dialog.result)
@@ -304,6 +2618,8 @@ class ExcelComparatorApp:
         self.settings["match_highlight"] = self.match_highlight.get()
         self.settings["partial_highlight"] = self.partial_highlight.get()
         self.settings["nomatch_highlight"] = self.nomatch_highlight.get()
+        self.settings["similar_highlight"] = self.similar_highlight.get()
+        self.settings["diff_highlight"] = self.diff_highlight.get()
         self.settings["header_border_thick"] = self.header_border_thick.get()
         self.settings["header_border_color"] = self.header_border_color.get()
         self.settings["body_border_thick"] = self.body_border_thick.get()
@@ -311,6 +2627,7 @@ class ExcelComparatorApp:
         self.settings["header_height"] = self.header_height.get()
         self.settings["body_height"] = self.body_height.get()
         self.settings["padding"] = self.padding.get()
+        self.settings["autofit_sample_rows"] = self.autofit_sample_rows.get()
         self.settings["sort_by_match"] = bool(self.sort_by_match.get())
         self.settings["filtered_output_enabled"] = bool(self.filtered_output_enabled.get())
         self.settings["filtered_output_type"] = self.filtered_output_type.get()
@@ -325,10 +2642,34 @@ class ExcelComparatorApp:
         self.settings["include2"] = self.include2
         self.settings["selected_sheet1"] = self.selected_sheet1.get()
         self.settings["selected_sheet2"] = self.selected_sheet2.get()
+        self.settings["compare_workers"] = self.compare_workers
+        self.settings["export_workers"] = self.export_workers
+        self.settings["streaming_compare"] = bool(self.streaming_compare.get())
+        self.settings["streaming_output"] = bool(self.streaming_output.get())
+        self.settings["stream_memory_mb"] = self.stream_memory_mb
+        self.settings["normalization"] = self.normalizer().settings()
+        self.settings["similarity_match"] = bool(self.similarity_enabled.get())
+        self.settings["similarity_threshold"] = self.similarity_threshold.get()
+        self.settings["pair_rows"] = bool(self.pair_rows.get())
+        self.settings["incremental_compare"] = bool(self.incremental_compare.get())
+        self.settings["workbook_mode"] = bool(self.workbook_mode.get())
+        self.settings["pairing_table"] = self.pairing_table_var.get()
+        self.settings["profiles_dir"] = self.profiles_dir_var.get()
+        self.settings["batch_mode"] = bool(self.batch_mode.get())
+        self.settings["batch_dir"] = self.batch_dir_var.get()
+        self.settings["sheet_cache_cells"] = self.sheet_cache.max_cells
+        self.settings["fast_reader"] = self.sheet_cache.fast_reader
+        self.settings["result_cache_size"] = self.result_cache.max_entries
+        self.settings["result_cache_on_disk"] = self.result_cache.directory is not None
+        self.settings["run_log"] = self.run_log
+        self.settings["memory_budget_mb"] = self.memory_budget_mb
+        self.settings["memory_auto_switch"] = self.memory_auto_switch
         with open(SETTINGS_FILE, "w") as f:
             json.dump(self.settings, f, indent=2)
 
     def on_close(self):
+        if self.job is not None:
+            self.job.cancel()
         self.save_settings()
         self.root.destroy()
 
@@ -420,6 +2761,112 @@ class ExcelComparatorApp:
             bootstyle="primary-round-toggle"
         ).grid(row=3, column=0, columnspan=6, sticky="w", padx=2, pady=(8,2))
 
+        self.streaming_compare = tk.BooleanVar()
+        self.streaming_compare.set(self.settings.get("streaming_compare", False))
+        Checkbutton(files_group,
+            text="Low-memory streaming compare (for sheets larger than RAM)",
+            variable=self.streaming_compare,
+            bootstyle="warning-round-toggle"
+        ).grid(row=4, column=0, columnspan=6, sticky="w", padx=2, pady=(4,2))
+
+        self.streaming_output = tk.BooleanVar()
+        self.streaming_output.set(self.settings.get("streaming_output", False))
+        Checkbutton(files_group,
+            text="Streaming output (write-only workbooks, flat memory)",
+            variable=self.streaming_output,
+            bootstyle="warning-round-toggle"
+        ).grid(row=7, column=0, columnspan=6, sticky="w", padx=2, pady=(4,2))
+
+        norm = Normalizer.from_settings(self.settings.get("normalization"))
+        match_frame = Frame(files_group)
+        match_frame.grid(row=8, column=0, columnspan=6, sticky="w", padx=2, pady=(4,2))
+        Label(match_frame, text="Treat as equal:").pack(side="left", padx=(0,6))
+        self.norm_trim = tk.BooleanVar(value=norm.trim)
+        self.norm_casefold = tk.BooleanVar(value=norm.casefold)
+        self.norm_numbers = tk.BooleanVar(value=norm.numbers)
+        self.norm_dates = tk.BooleanVar(value=norm.dates)
+        self.norm_blank = tk.BooleanVar(value=norm.blank_is_empty)
+        for text, var in (("Extra spaces", self.norm_trim), ("Case", self.norm_casefold),
+                          ("Same number", self.norm_numbers)):
+            Checkbutton(match_frame, text=text, variable=var, bootstyle="primary-round-toggle").pack(side="left", padx=(0,8))
+        Label(match_frame, text="rounded to the nearest multiple of").pack(side="left", padx=(0,4))
+        self.norm_tolerance = Entry(match_frame, width=8)
+        self.norm_tolerance.insert(0, norm.tolerance or "")
+        self.norm_tolerance.pack(side="left", padx=(0,8))
+        for text, var in (("Same date", self.norm_dates), ("Blank and empty", self.norm_blank)):
+            Checkbutton(match_frame, text=text, variable=var, bootstyle="primary-round-toggle").pack(side="left", padx=(0,8))
+
+        similar_frame = Frame(files_group)
+        similar_frame.grid(row=9, column=0, columnspan=6, sticky="w", padx=2, pady=(4,2))
+        self.similarity_enabled = tk.BooleanVar()
+        self.similarity_enabled.set(self.settings.get("similarity_match", False))
+        Checkbutton(similar_frame,
+            text="Similarity Match (fuzzy rows, adds a Similarity column; not with streaming compare)",
+            variable=self.similarity_enabled,
+            bootstyle="primary-round-toggle"
+        ).pack(side="left", padx=(0,8))
+        Label(similar_frame, text="Threshold %:").pack(side="left")
+        self.similarity_threshold = Spinbox(similar_frame, from_=50, to=100, width=5)
+        self.similarity_threshold.insert(0, self.settings.get("similarity_threshold", 85))
+        self.similarity_threshold.pack(side="left", padx=2)
+
+        self.pair_rows = tk.BooleanVar()
+        self.pair_rows.set(self.settings.get("pair_rows", False))
+        Checkbutton(files_group,
+            text="Show each row's best partner row and highlight differing cells (not with streaming compare)",
+            variable=self.pair_rows,
+            bootstyle="primary-round-toggle"
+        ).grid(row=10, column=0, columnspan=6, sticky="w", padx=2, pady=(4,2))
+
+        self.incremental_compare = tk.BooleanVar()
+        self.incremental_compare.set(self.settings.get("incremental_compare", False))
+        Checkbutton(files_group,
+            text="Incremental re-compare (keep a match index and only re-check changed rows)",
+            variable=self.incremental_compare,
+            bootstyle="primary-round-toggle"
+        ).grid(row=11, column=0, columnspan=6, sticky="w", padx=2, pady=(4,2))
+
+        self.profile_next_run = tk.BooleanVar(value=False)
+        Checkbutton(files_group,
+            text="Profile the next run (saves its slowest functions next to the output)",
+            variable=self.profile_next_run,
+            bootstyle="secondary-round-toggle"
+        ).grid(row=12, column=0, columnspan=6, sticky="w", padx=2, pady=(4,2))
+
+        workbook_frame = Frame(files_group)
+        workbook_frame.grid(row=13, column=0, columnspan=6, sticky="w", padx=2, pady=(4,2))
+        self.workbook_mode = tk.BooleanVar()
+        self.workbook_mode.set(self.settings.get("workbook_mode", False))
+        Checkbutton(workbook_frame,
+            text="Compare all sheets",
+            variable=self.workbook_mode,
+            bootstyle="primary-round-toggle"
+        ).pack(side="left", padx=(0,8))
+        Label(workbook_frame, text="Pairing table:").pack(side="left")
+        self.pairing_table_var = tk.StringVar(value=self.settings.get("pairing_table", ""))
+        Entry(workbook_frame, textvariable=self.pairing_table_var, width=22).pack(side="left", padx=2)
+        Button(workbook_frame, text="…", width=2, bootstyle="secondary-outline",
+               command=lambda: self.pick_path(self.pairing_table_var, [("CSV files", "*.csv")])).pack(side="left", padx=(0,8))
+        Label(workbook_frame, text="Profiles folder:").pack(side="left")
+        self.profiles_dir_var = tk.StringVar(value=self.settings.get("profiles_dir", ""))
+        Entry(workbook_frame, textvariable=self.profiles_dir_var, width=22).pack(side="left", padx=2)
+        Button(workbook_frame, text="…", width=2, bootstyle="secondary-outline",
+               command=lambda: self.pick_path(self.profiles_dir_var)).pack(side="left")
+
+        batch_frame = Frame(files_group)
+        batch_frame.grid(row=14, column=0, columnspan=6, sticky="w", padx=2, pady=(4,2))
+        self.batch_mode = tk.BooleanVar()
+        self.batch_mode.set(self.settings.get("batch_mode", False))
+        Checkbutton(batch_frame,
+            text="Compare File 1 against every workbook in folder",
+            variable=self.batch_mode,
+            bootstyle="primary-round-toggle"
+        ).pack(side="left", padx=(0,8))
+        self.batch_dir_var = tk.StringVar(value=self.settings.get("batch_dir", ""))
+        Entry(batch_frame, textvariable=self.batch_dir_var, width=30).pack(side="left", padx=2)
+        Button(batch_frame, text="…", width=2, bootstyle="secondary-outline",
+               command=lambda: self.pick_path(self.batch_dir_var)).pack(side="left")
+
         self.export_match_types_separately = tk.BooleanVar()
         self.export_match_types_separately.set(self.settings.get("export_match_types_separately", False))
         Checkbutton(files_group,
@@ -430,7 +2877,8 @@ class ExcelComparatorApp:
 
         partial_frame = Frame(files_group)
         partial_frame.grid(row=6, column=0, columnspan=6, sticky="w", padx=2, pady=(4,2))
-        Button(partial_frame, text="Export Partial Match Rows Only", command=self.export_partial_match_rows, bootstyle="warning-outline").pack(side="left", padx=(0,8))
+        self.partial_button = Button(partial_frame, text="Export Partial Match Rows Only", command=self.export_partial_match_rows, bootstyle="warning-outline")
+        self.partial_button.pack(side="left", padx=(0,8))
         self.partial_from_var = tk.StringVar()
         self.partial_from_var.set("Both")
         Combobox(partial_frame, textvariable=self.partial_from_var, values=["File1", "File2", "Both"], width=10, state="readonly").pack(side="left", padx=(2,14))
@@ -509,6 +2957,18 @@ class ExcelComparatorApp:
         self.nomatch_highlight_swatch = tk.Label(fmt_group, width=2, bg="#ffffff", relief="groove")
         self.nomatch_highlight_swatch.grid(row=2, column=10, padx=2)
         Button(fmt_group, text="Pick", command=lambda: self.pick_color(self.nomatch_highlight, self.nomatch_highlight_swatch), bootstyle="secondary").grid(row=2, column=11, padx=2)
+        Label(fmt_group, text="Similar:").grid(row=2, column=12, sticky="e")
+        self.similar_highlight = Entry(fmt_group, width=10)
+        self.similar_highlight.grid(row=2, column=13, padx=2)
+        self.similar_highlight_swatch = tk.Label(fmt_group, width=2, bg="#ddebf7", relief="groove")
+        self.similar_highlight_swatch.grid(row=2, column=14, padx=2)
+        Button(fmt_group, text="Pick", command=lambda: self.pick_color(self.similar_highlight, self.similar_highlight_swatch), bootstyle="secondary").grid(row=2, column=15, padx=2)
+        Label(fmt_group, text="Differs:").grid(row=3, column=0, sticky="e", padx=2, pady=(6,2))
+        self.diff_highlight = Entry(fmt_group, width=10)
+        self.diff_highlight.grid(row=3, column=1, padx=2, pady=(6,2))
+        self.diff_highlight_swatch = tk.Label(fmt_group, width=2, bg="#f8cbad", relief="groove")
+        self.diff_highlight_swatch.grid(row=3, column=2, padx=2, pady=(6,2))
+        Button(fmt_group, text="Pick", command=lambda: self.pick_color(self.diff_highlight, self.diff_highlight_swatch), bootstyle="secondary").grid(row=3, column=3, padx=2, pady=(6,2))
 
         self.sort_by_match = tk.BooleanVar()
         self.sort_by_match.set(self.settings.get("sort_by_match", False))
@@ -530,7 +2990,7 @@ class ExcelComparatorApp:
                                         command=self.toggle_filtered_output_controls)
         self.filter_check.pack(side="left", padx=(0,10))
         Label(filter_frame, text="Type:").pack(side="left")
-        self.filter_type_combo = Combobox(filter_frame, textvariable=self.filtered_output_type, values=["Full Match", "Partial Match", "No Match"], width=15, state="readonly")
+        self.filter_type_combo = Combobox(filter_frame, textvariable=self.filtered_output_type, values=MATCH_TYPES, width=15, state="readonly")
         self.filter_type_combo.pack(side="left", padx=(2,10))
         Label(filter_frame, text="File:").pack(side="left")
         self.filter_output_combo = Combobox(filter_frame, textvariable=self.filtered_output_file_var, width=40, values=self.recent_filtered_outputs, state="readonly")
@@ -547,11 +3007,24 @@ class ExcelComparatorApp:
         self.body_height.pack(side="left", padx=(2,10))
         Label(row_fmt, text="Column Padding:").pack(side="left")
         self.padding = Spinbox(row_fmt, from_=0, to=10, width=5)
-        self.padding.pack(side="left", padx=2)
+        self.padding.pack(side="left", padx=(2,10))
+        Label(row_fmt, text="Autofit Rows (0 = all):").pack(side="left")
+        self.autofit_sample_rows = Spinbox(row_fmt, from_=0, to=1000000, increment=100, width=8)
+        self.autofit_sample_rows.pack(side="left", padx=2)
 
         btn_frame = Frame(main)
         btn_frame.pack(fill="x", pady=(18,6))
-        Button(btn_frame, text="Compare and Save Output", command=self.compare_and_save, width=30, bootstyle="success").pack(pady=2)
+        self.compare_button = Button(btn_frame, text="Compare and Save Output", command=self.compare_and_save, width=30, bootstyle="success")
+        self.compare_button.pack(pady=2)
+
+        progress_frame = Frame(main)
+        progress_frame.pack(fill="x", pady=(0,6))
+        self.progress_bar = Progressbar(progress_frame, mode="determinate", bootstyle="success-striped")
+        self.progress_bar.pack(side="left", fill="x", expand=True, padx=(0,8))
+        self.cancel_button = Button(progress_frame, text="Cancel", command=self.cancel_job, bootstyle="danger-outline", state="disabled")
+        self.cancel_button.pack(side="left")
+        self.progress_var = tk.StringVar(value="")
+        Label(main, textvariable=self.progress_var, anchor="w").pack(fill="x")
 
         self.status_var = tk.StringVar(value="Ready.")
         statusbar = Label(main, textvariable=self.status_var, anchor="w", bootstyle="inverse-secondary")
@@ -559,59 +3032,79 @@ class ExcelComparatorApp:
 
         self.toggle_filtered_output_controls()
         
-    def reload_data1(self):
+    def reload_header1(self, path=None, sheet=None):
+        path = self.f1_var.get() if path is None else path
+        sheet = self.selected_sheet1.get() if sheet is None else sheet
         try:
-            wb = openpyxl.load_workbook(self.f1_var.get(), read_only=True)
-            ws = wb[self.selected_sheet1.get()]
-            self.data1 = [list(row) for row in ws.iter_rows(values_only=True)]
-            self.headers1 = list(self.data1[0])
+            self.headers1 = list(self.sheet_cache.header(path, sheet))
             if not self.include1 or len(self.include1) != len(self.headers1):
                 self.include1 = [True]*len(self.headers1)
-            wb.close()
         except Exception:
-            self.data1 = []
             self.headers1 = []
             self.include1 = []
 
-    def reload_data2(self):
+    def reload_header2(self, path=None, sheet=None):
+        path = self.f2_var.get() if path is None else path
+        sheet = self.selected_sheet2.get() if sheet is None else sheet
         try:
-            wb = openpyxl.load_workbook(self.f2_var.get(), read_only=True)
-            ws = wb[self.selected_sheet2.get()]
-            self.data2 = [list(row) for row in ws.iter_rows(values_only=True)]
-            self.headers2 = list(self.data2[0])
+            self.headers2 = list(self.sheet_cache.header(path, sheet))
             if not self.include2 or len(self.include2) != len(self.headers2):
                 self.include2 = [True]*len(self.headers2)
-            wb.close()
         except Exception:
-            self.data2 = []
             self.headers2 = []
             self.include2 = []
 
+    def select_sheet(self, which):
+        # Only the sheet list, header row and dimension are read here; the
+        # rows themselves are loaded when a comparison runs.
+        if self.job_running():
+            return
+        if which == 1:
+            self.reload_header1()
+            path, sheet, headers = self.f1_var.get(), self.selected_sheet1.get(), self.headers1
+        else:
+            self.reload_header2()
+            path, sheet, headers = self.f2_var.get(), self.selected_sheet2.get(), self.headers2
+        if not headers:
+            return
+        rows = self.sheet_cache.sheet_info(path, sheet)[3]
+        size = f"~{rows:,} rows" if rows is not None else "row count unknown"
+        self.status_var.set(f"{os.path.basename(path)} [{sheet}]: {len(headers)} columns, {size}")
+
+    def pick_path(self, var, filetypes=None):
+        # Browse for a file with filetypes, else for a folder.
+        if filetypes:
+            path = filedialog.askopenfilename(filetypes=filetypes)
+        else:
+            path = filedialog.askdirectory()
+        if path:
+            var.set(path)
+
     def pick_file(self, which):
+        if self.job_running():
+            return
         fname = filedialog.askopenfilename(filetypes=[("Excel files", "*.xlsx *.xls")])
         if not fname:
             return
         self.update_recent_files(fname)
-        wb = openpyxl.load_workbook(fname, read_only=True)
-        sheetnames = wb.sheetnames
-        wb.close()
+        selected = self.selected_sheet1 if which == 1 else self.selected_sheet2
+        sheetnames = self.sheet_cache.sheet_info(fname, selected.get())[0]
         if which == 1:
             self.f1_var.set(fname)
             self.sheetnames1 = sheetnames
             self.sheet1_combo['values'] = self.sheetnames1
             if self.selected_sheet1.get() not in self.sheetnames1:
                 self.selected_sheet1.set(self.sheetnames1[0])
-            self.reload_data1()
         else:
             self.f2_var.set(fname)
             self.sheetnames2 = sheetnames
             self.sheet2_combo['values'] = self.sheetnames2
             if self.selected_sheet2.get() not in self.sheetnames2:
                 self.selected_sheet2.set(self.sheetnames2[0])
-            self.reload_data2()
+        self.select_sheet(which)
         self.save_settings()
-        self.sheet1_combo.bind("<<ComboboxSelected>>", lambda e: self.reload_data1())
-        self.sheet2_combo.bind("<<ComboboxSelected>>", lambda e: self.reload_data2())
+        self.sheet1_combo.bind("<<ComboboxSelected>>", lambda e: self.select_sheet(1))
+        self.sheet2_combo.bind("<<ComboboxSelected>>", lambda e: self.select_sheet(2))
 
     def pick_output(self):
         fname = filedialog.asksaveasfilename(defaultextension=".xlsx", filetypes=[("Excel files", "*.xlsx")])
@@ -683,18 +3176,46 @@ class ExcelComparatorApp:
         self.nomatch_highlight.delete(0, tk.END)
         self.nomatch_highlight.insert(0, s.get("nomatch_highlight", "#ffffff"))
         self.nomatch_highlight_swatch.config(bg=s.get("nomatch_highlight", "#ffffff"))
+        self.similar_highlight.delete(0, tk.END)
+        self.similar_highlight.insert(0, s.get("similar_highlight", "#ddebf7"))
+        self.similar_highlight_swatch.config(bg=s.get("similar_highlight", "#ddebf7"))
+        self.diff_highlight.delete(0, tk.END)
+        self.diff_highlight.insert(0, s.get("diff_highlight", "#f8cbad"))
+        self.diff_highlight_swatch.config(bg=s.get("diff_highlight", "#f8cbad"))
         self.header_height.delete(0, tk.END)
         self.header_height.insert(0, s.get("header_height", 24))
         self.body_height.delete(0, tk.END)
         self.body_height.insert(0, s.get("body_height", 18))
         self.padding.delete(0, tk.END)
         self.padding.insert(0, s.get("padding", 2))
+        self.autofit_sample_rows.delete(0, tk.END)
+        self.autofit_sample_rows.insert(0, s.get("autofit_sample_rows", 0))
         self.sort_by_match.set(s.get("sort_by_match", False))
         self.filtered_output_enabled.set(s.get("filtered_output_enabled", False))
         self.filtered_output_type.set(s.get("filtered_output_type", "Full Match"))
         self.filtered_output_file_var.set(s.get("filtered_output_file", ""))
         self.export_mapped_only.set(s.get("export_mapped_only", False))
         self.export_match_types_separately.set(s.get("export_match_types_separately", False))
+        self.streaming_compare.set(s.get("streaming_compare", False))
+        self.streaming_output.set(s.get("streaming_output", False))
+        norm = Normalizer.from_settings(s.get("normalization"))
+        self.norm_trim.set(norm.trim)
+        self.norm_casefold.set(norm.casefold)
+        self.norm_numbers.set(norm.numbers)
+        self.norm_dates.set(norm.dates)
+        self.norm_blank.set(norm.blank_is_empty)
+        self.norm_tolerance.delete(0, tk.END)
+        self.norm_tolerance.insert(0, norm.tolerance or "")
+        self.similarity_enabled.set(s.get("similarity_match", False))
+        self.similarity_threshold.delete(0, tk.END)
+        self.similarity_threshold.insert(0, s.get("similarity_threshold", 85))
+        self.pair_rows.set(s.get("pair_rows", False))
+        self.incremental_compare.set(s.get("incremental_compare", False))
+        self.workbook_mode.set(s.get("workbook_mode", False))
+        self.pairing_table_var.set(s.get("pairing_table", ""))
+        self.profiles_dir_var.set(s.get("profiles_dir", ""))
+        self.batch_mode.set(s.get("batch_mode", False))
+        self.batch_dir_var.set(s.get("batch_dir", ""))
         self.include1 = s.get("include1", [])
         self.include2 = s.get("include2", [])
         self.selected_sheet1.set(s.get("selected_sheet1", ""))
@@ -707,127 +3228,52 @@ class ExcelComparatorApp:
         self.filter_type_combo.configure(state=state)
         self.filter_output_combo.configure(state=state)
 
-    def show_dashboard(self, counts_A, counts_B, total_A, total_B):
+    def show_dashboard(self, counts_A, counts_B, total_A, total_B, timings=None):
         def pct(val, total):
             return f"{val} ({val/total*100:.1f}%)" if total else "0 (0%)"
+        def similar(counts, total):
+            if not counts_A.get("Similar Match") and not counts_B.get("Similar Match"):
+                return ""
+            return f"  Similar Match: {pct(counts['Similar Match'], total)}\n"
         msg = (
             f"Dashboard Summary:\n\n"
             f"File 1 (Rows: {total_A}):\n"
             f"  Full Match: {pct(counts_A['Full Match'], total_A)}\n"
+            f"{similar(counts_A, total_A)}"
             f"  Partial Match: {pct(counts_A['Partial Match'], total_A)}\n"
             f"  No Match: {pct(counts_A['No Match'], total_A)}\n\n"
             f"File 2 (Rows: {total_B}):\n"
             f"  Full Match: {pct(counts_B['Full Match'], total_B)}\n"
+            f"{similar(counts_B, total_B)}"
             f"  Partial Match: {pct(counts_B['Partial Match'], total_B)}\n"
             f"  No Match: {pct(counts_B['No Match'], total_B)}"
         )
+        if timings:
+            msg += f"\n\nTimings:\n{format_timings(timings)}"
         messagebox.showinfo("Comparison Summary", msg)
 
-    def get_annotated_rows(self, data_main, data_other, mapping):
-        row_info = []
-        mapped_indices = list(mapping.items())
-        for row_main in data_main[1:]:
-            status = "No Match"
-            for row_other in data_other[1:]:
-                try:
-                    matches = [
-                        str(row_main[i1]) == str(row_other[i2])
-                        for i1, i2 in mapped_indices
-                        if i1 < len(row_main) and i2 < len(row_other)
-                    ]
-                    if matches and all(matches):
-                        status = "Full Match"
-                        break
-                    elif matches and any(matches):
-                        status = "Partial Match"
-                except Exception:
-                    continue
-            row_info.append((row_main, status))
-        return row_info
-
-    def write_output_sheet(self, ws, row_info, headers, opts, mapping, is_file1, export_mapped_only):
-        from openpyxl.styles import Alignment
-        hfont = get_font(opts["header_font"], opts["header_size"], True, opts["header_fontcolor"])
-        bfont = get_font(opts["body_font"], opts["body_size"], False, opts["body_fontcolor"])
-        hfill = get_fill(opts["header_fill"])
-        bfill = get_fill(opts["body_fill"])
-        hborder = get_border(opts["header_border_thick"], opts["header_border_color"])
-        bborder = get_border(opts["body_border_thick"], opts["body_border_color"])
-        match_fill = get_fill(opts["match_highlight"])
-        partial_fill = get_fill(opts["partial_highlight"])
-        nomatch_fill = get_fill(opts["nomatch_highlight"])
-        align_center = Alignment(horizontal="center", vertical="center")
-        pad = opts["padding"]
-
-        mapped_cols = []
-        if export_mapped_only:
-            if mapping:
-                if is_file1:
-                    mapped_cols = [k for k, _ in sorted(mapping.items()) if k < len(headers)]
-                else:
-                    mapped_cols = [v for _, v in sorted(mapping.items()) if v < len(headers)]
-            if not mapped_cols:
-                mapped_cols = list(range(len(headers)))
-        else:
-            mapped_cols = list(range(len(headers)))
+    def worker_count(self):
+        return resolve_workers(self.compare_workers)
 
-        for col_idx, header_index in enumerate(mapped_cols, 1):
-            cell = ws.cell(row=1, column=col_idx, value=headers[header_index])
-            cell.font = hfont
-            cell.fill = hfill
-            cell.border = hborder
-            cell.alignment = align_center
-        ws.cell(row=1, column=len(mapped_cols)+1, value="MatchType").font = hfont
-        for col_idx in range(1, len(mapped_cols)+2):
-            ws.cell(row=1, column=col_idx).fill = hfill
-            ws.cell(row=1, column=col_idx).border = hborder
-            ws.cell(row=1, column=col_idx).alignment = align_center
-        ws.row_dimensions[1].height = opts["header_height"]
-
-        ws.freeze_panes = ws['A2']
-        max_row = max(2, len(row_info) + 1)
-        ws.auto_filter.ref = f"A1:{openpyxl.utils.get_column_letter(len(mapped_cols)+1)}{max_row}"
-
-        for idx, (row_main, status) in enumerate(row_info, start=2):
-            for col_idx, header_index in enumerate(mapped_cols, 1):
-                value = row_main[header_index] if header_index < len(row_main) else ""
-                cell = ws.cell(row=idx, column=col_idx, value=value)
-                cell.font = bfont
-                cell.fill = bfill
-                cell.border = bborder
-                cell.alignment = align_center
-
-            matchtype_cell = ws.cell(row=idx, column=len(mapped_cols)+1, value=status)
-            matchtype_cell.font = bfont
-            for col_idx in range(1, len(mapped_cols)+2):
-                ws.cell(row=idx, column=col_idx).alignment = align_center
-            ws.row_dimensions[idx].height = opts["body_height"]
-
-            if status == "Full Match":
-                row_fill = match_fill
-                font_bold = False
-            elif status == "Partial Match":
-                row_fill = partial_fill
-                font_bold = True
-            else:
-                row_fill = nomatch_fill
-                font_bold = True
-            for col_idx in range(1, len(mapped_cols)+2):
-                ws.cell(row=idx, column=col_idx).fill = row_fill
-                if font_bold:
-                    ws.cell(row=idx, column=col_idx).font = get_font(
-                        opts["body_font"],
-                        opts["body_size"],
-                        True,
-                        opts["body_fontcolor"]
-                    )
-        autofit_columns(ws, extra_padding=pad)
+    def export_worker_count(self):
+        return resolve_workers(self.export_workers)
 
-    def compare_and_save(self):
-        self.save_settings()
-        self.reload_data1()
-        self.reload_data2()
-        opts = {
+    def normalizer(self):
+        try:
+            tolerance = abs(float(self.norm_tolerance.get() or 0))
+        except ValueError:
+            tolerance = 0.0
+        return Normalizer(
+            trim=bool(self.norm_trim.get()),
+            casefold=bool(self.norm_casefold.get()),
+            numbers=bool(self.norm_numbers.get()),
+            tolerance=tolerance,
+            dates=bool(self.norm_dates.get()),
+            blank_is_empty=bool(self.norm_blank.get()),
+        )
+
+    def output_options(self):
+        return {
             "header_font": self.header_font.get(),
             "header_size": int(self.header_size.get()),
             "header_fill": self.header_fill.get(),
@@ -843,19 +3289,263 @@ class ExcelComparatorApp:
             "match_highlight": self.match_highlight.get(),
             "partial_highlight": self.partial_highlight.get(),
             "nomatch_highlight": self.nomatch_highlight.get(),
+            "similar_highlight": self.similar_highlight.get(),
+            "diff_highlight": self.diff_highlight.get(),
             "header_height": int(self.header_height.get()),
             "body_height": int(self.body_height.get()),
-            "padding": int(self.padding.get())
+            "padding": int(self.padding.get()),
+            "autofit_sample_rows": int(self.autofit_sample_rows.get())
         }
+
+    def reload_headers(self, path1, sheet1, path2, sheet2):
+        self.reload_header1(path1, sheet1)
+        self.reload_header2(path2, sheet2)
+
+    def comparison_inputs(self):
+        # Everything run_comparison needs from Tk variables, read up front so
+        # the comparison itself can run off the main thread.
+        return (self.f1_var.get(), self.selected_sheet1.get(),
+                self.f2_var.get(), self.selected_sheet2.get(), self.streaming_compare.get(),
+                self.normalizer(), self.similarity(), bool(self.pair_rows.get()),
+                bool(self.incremental_compare.get()))
+
+    def memory_model(self):
+        # Calibrated once per openpyxl version; the costs are kept in the
+        # settings.
+        stored = self.settings.get("memory_costs") or {}
+        if stored.get("openpyxl") == openpyxl.__version__:
+            return MemoryModel(stored)
+        model = MemoryModel.calibrate(self.output_options())
+        self.settings["memory_costs"] = dict(model.costs, openpyxl=openpyxl.__version__)
+        return model
+
+    def memory_preflight(self, inputs, write_only):
+        # Estimates the run's peak memory from the sheets' dimensions before
+        # anything is loaded. Over budget, the run switches to streaming
+        # compare and output (automatically with memory_auto_switch, else
+        # after asking) or the user is warned. Returns the (inputs,
+        # write_only) to run with, or None when the user cancels.
+        path1, sheet1, path2, sheet2, streaming = inputs[:5]
+        try:
+            header1, rows1, exact1 = self.sheet_cache.extent(path1, sheet1)
+            header2, rows2, exact2 = self.sheet_cache.extent(path2, sheet2)
+        except Exception:
+            return inputs, write_only
+        include1 = self.include1 if len(self.include1) == len(header1) else [True] * len(header1)
+        include2 = self.include2 if len(self.include2) == len(header2) else [True] * len(header2)
+        mapped = sum(1 for k, v in self.mapping.items()
+                     if k < len(include1) and include1[k] and v < len(include2) and include2[v])
+        rows = rows1 + rows2
+        cells = rows1 * sum(map(bool, include1)) + rows2 * sum(map(bool, include2))
+        stream_memory = int(self.stream_memory_mb) * 1024 * 1024
+        budget = int(self.memory_budget_mb * 1024 * 1024) if self.memory_budget_mb else default_memory_budget()
+        model = self.memory_model()
+        estimate = model.estimate(cells, mapped * rows, rows, streaming, write_only, stream_memory)
+        if estimate <= budget:
+            return inputs, write_only
+        low = model.estimate(cells, mapped * rows, rows, True, True, stream_memory)
+        mb = 1024 * 1024
+        msg = (f"The sheets hold about {rows:,} rows"
+               f"{'' if exact1 and exact2 else ' (estimated from the file size)'}; this run would need "
+               f"about {estimate // mb:,} MB, over the {budget // mb:,} MB memory budget.")
+        if low < estimate and low <= budget:
+            if not self.memory_auto_switch:
+                answer = messagebox.askyesnocancel("Large Sheets",
+                    f"{msg}\n\nSwitch this run to streaming compare and streaming output "
+                    f"(about {low // mb:,} MB; no similarity, pairing or incremental mode)?")
+                if answer is None:
+                    return None
+                if not answer:
+                    return inputs, write_only
+            self.status_var.set("Using streaming compare and output to stay within the memory budget.")
+            return inputs[:4] + (True,) + inputs[5:], True
+        if messagebox.askokcancel("Large Sheets", f"{msg}\n\nRun anyway?"):
+            return inputs, write_only
+        return None
+
+    def similarity(self):
+        # Similar Match threshold as a fraction, or None when the mode is off.
+        if not self.similarity_enabled.get():
+            return None
+        try:
+            percent = float(self.similarity_threshold.get())
+        except ValueError:
+            percent = 85.0
+        return min(100.0, max(1.0, percent)) / 100
+
+    def run_comparison(self, inputs=None, progress=None):
+        path1, sheet1, path2, sheet2, streaming, normalizer, similarity, pair_rows, incremental = (
+            inputs or self.comparison_inputs())
+        self.reload_headers(path1, sheet1, path2, sheet2)
+        headers1, headers2 = self.headers1, self.headers2
+        include1 = [i for i, v in enumerate(self.include1) if v]
+        include2 = [i for i, v in enumerate(self.include2) if v]
+        mapping = {k: v for k, v in self.mapping.items() if k in include1 and v in include2}
+        used_headers1 = [headers1[i] for i in include1]
+        used_headers2 = [headers2[i] for i in include2]
+        key = comparison_key(
+            path1, sheet1, include1, path2, sheet2, include2, mapping, normalizer,
+            None if streaming else similarity, pair_rows and not streaming
+        ) if headers1 and headers2 else None
+        cached = self.result_cache.get(key)
+        if streaming and headers1 and headers2:
+            source1 = SheetSource(path1, sheet1, include1, self.sheet_cache.fast_reader)
+            source2 = SheetSource(path2, sheet2, include2, self.sheet_cache.fast_reader)
+            if cached:
+                return used_headers1, used_headers2, mapping, StreamedComparisonResult(
+                    source1, source2, mapping, bytearray(cached[0]), bytearray(cached[1]))
+            result = compare_streamed(source1, source2, mapping, int(self.stream_memory_mb) * 1024 * 1024,
+                                      progress, normalizer)
+        else:
+            # Only the included columns are kept while loading; the full
+            # header row comes from reload_headers().
+            used_data1 = self.sheet_cache.rows(path1, sheet1, progress, include1) if headers1 else []
+            used_data2 = self.sheet_cache.rows(path2, sheet2, progress, include2) if headers2 else []
+            if cached and len(cached[0]) == len(used_data1[1:]) and len(cached[1]) == len(used_data2[1:]):
+                return used_headers1, used_headers2, mapping, ComparisonResult(
+                    used_data1, used_data2, mapping,
+                    [STATUS_LABELS[c] for c in cached[0]], [STATUS_LABELS[c] for c in cached[1]],
+                    normalizer=normalizer, **cached[2])
+            if incremental and not similarity and not pair_rows and MatchIndex.supports(used_data1, used_data2):
+                # Keyed by the setup only, so an edited file finds the index
+                # of its previous version.
+                index_key = (os.path.abspath(path1), sheet1, tuple(include1),
+                             os.path.abspath(path2), sheet2, tuple(include2),
+                             tuple(sorted(mapping.items())), normalizer.options())
+                result, index, _ = compare_incremental(used_data1, used_data2, mapping,
+                                                       self.match_indexes.get(index_key), normalizer, progress)
+                self.match_indexes.put(index_key, index)
+            else:
+                result = compare_sheets(used_data1, used_data2, mapping,
+                                        progress=progress, normalizer=normalizer, similarity=similarity,
+                                        pair_rows=pair_rows)
+        self.result_cache.put(key, result.status_codes(file1=True), result.status_codes(file1=False), result.details)
+        return used_headers1, used_headers2, mapping, result
+
+    def start_job(self, work, profile_path=None):
+        # Runs work(progress) on a worker thread. The worker only touches the
+        # GUI through post(), whose calls poll_job() replays on the Tk loop.
+        # With profile_path, the run is profiled and its top functions are
+        # written there.
+        progress = Progress()
+        self.job = progress
+        self.set_running(True)
+        def run():
+            profiler = cProfile.Profile() if profile_path else None
+            try:
+                if profiler is not None:
+                    profiler.enable()
+                work(progress)
+            except Cancelled:
+                self.post(self.status_var.set, "Cancelled.")
+            except Exception as e:
+                self.post(messagebox.showerror, "Error", str(e))
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                    self.save_profile(profiler, profile_path)
+                self.post(self.end_job)
+        threading.Thread(target=run, daemon=True).start()
+        self.root.after(100, self.poll_job)
+
+    def profile_path(self, outname):
+        # Profiling is armed for one run at a time.
+        if not self.profile_next_run.get():
+            return None
+        self.profile_next_run.set(False)
+        return os.path.splitext(outname)[0] + "_profile.txt"
+
+    def save_profile(self, profiler, path):
+        out = io.StringIO()
+        stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats("cumulative").print_stats(PROFILE_TOP)
+        stats.sort_stats("tottime").print_stats(PROFILE_TOP)
         try:
-            headers1, headers2 = self.headers1, self.headers2
-            data1, data2 = self.data1, self.data2
-            include1 = [i for i, v in enumerate(self.include1) if v]
-            include2 = [i for i, v in enumerate(self.include2) if v]
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to open files:\n{e}")
+            with open(path, "w") as f:
+                f.write(out.getvalue())
+        except OSError as e:
+            self.post(messagebox.showerror, "Error", f"Failed to save profile:\n{e}")
+            return
+        self.post(self.status_var.set, f"Profile saved: {path}")
+
+    def log_run(self, action, inputs, progress, **details):
+        # Appends one JSON line per finished run to RUN_LOG_FILE.
+        if not self.run_log:
             return
+        path1, sheet1, path2, sheet2, streaming, normalizer, similarity, pair_rows, incremental = inputs
+        record = {
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "action": action,
+            "file1": path1, "sheet1": sheet1, "file2": path2, "sheet2": sheet2,
+            "streaming": bool(streaming), "similarity": similarity, "pair_rows": pair_rows,
+            "incremental": incremental, "normalization": normalizer.settings(),
+            "seconds": round(progress.elapsed(), 3),
+            "stages": [
+                {"stage": stage, "seconds": round(seconds, 3), "rows": rows,
+                 "rows_per_second": round(rows / seconds) if rows and seconds else None}
+                for stage, seconds, rows in progress.stage_timings()
+            ],
+        }
+        record.update(details)
+        try:
+            with open(RUN_LOG_FILE, "a") as f:
+                f.write(json.dumps(record, default=str) + "\n")
+        except OSError:
+            pass
+
+    def post(self, func, *args):
+        self.job_queue.put((func, args))
+
+    def poll_job(self):
+        if self.job is not None:
+            self.show_progress(self.job)
+        while True:
+            try:
+                func, args = self.job_queue.get_nowait()
+            except queue.Empty:
+                break
+            func(*args)
+        if self.job is not None:
+            self.root.after(100, self.poll_job)
+
+    def show_progress(self, progress):
+        if progress.total:
+            self.progress_bar.configure(mode="determinate", maximum=progress.total, value=min(progress.done, progress.total))
+            self.progress_var.set(f"{progress.stage}: {progress.done:,} / {progress.total:,} rows")
+        else:
+            self.progress_bar.configure(mode="indeterminate")
+            self.progress_bar.step()
+            self.progress_var.set(f"{progress.stage}: {progress.done:,} rows")
+
+    def set_running(self, running):
+        state = "disabled" if running else "normal"
+        self.compare_button.configure(state=state)
+        self.partial_button.configure(state=state)
+        self.cancel_button.configure(state="normal" if running else "disabled")
+        if not running:
+            self.progress_bar.configure(mode="determinate", value=0)
+            self.progress_var.set("")
+
+    def end_job(self):
+        self.job = None
+        self.set_running(False)
+
+    def cancel_job(self):
+        if self.job is not None and not self.job.cancel_event.is_set():
+            self.job.cancel()
+            self.status_var.set("Cancelling...")
+
+    def job_running(self):
+        if self.job is not None:
+            messagebox.showwarning("Busy", "A comparison is still running.")
+            return True
+        return False
 
+    def compare_and_save(self):
+        if self.job_running():
+            return
+        self.save_settings()
+        opts = self.output_options()
         outname = self.out_var.get()
         if not outname:
             outname = filedialog.asksaveasfilename(defaultextension=".xlsx", filetypes=[("Excel files", "*.xlsx")])
@@ -865,97 +3555,360 @@ class ExcelComparatorApp:
             self.update_recent_outputs(outname)
             self.out_combo["values"] = self.recent_outputs
 
-        mapping = {k: v for k, v in self.mapping.items() if k in include1 and v in include2}
-        used_headers1 = [headers1[i] for i in include1]
-        used_headers2 = [headers2[i] for i in include2]
-        used_data1 = [[row[i] for i in include1] for row in data1]
-        used_data2 = [[row[i] for i in include2] for row in data2]
-
-        row_info_A = self.get_annotated_rows(used_data1, used_data2, mapping)
-        reverse_mapping = {v: k for k, v in mapping.items()}
-        row_info_B = self.get_annotated_rows(used_data2, used_data1, reverse_mapping)
-
-        if self.sort_by_match.get():
-            sort_order = {"Full Match": 0, "Partial Match": 1, "No Match": 2}
-            row_info_A.sort(key=lambda x: sort_order.get(x[1], 99))
-            row_info_B.sort(key=lambda x: sort_order.get(x[1], 99))
-
-        def count_types(row_info):
-            d = {"Full Match": 0, "Partial Match": 0, "No Match": 0}
-            for _, status in row_info:
-                if status in d: d[status] += 1
-            return d
-        counts_A = count_types(row_info_A)
-        counts_B = count_types(row_info_B)
-        total_A = len(row_info_A)
-        total_B = len(row_info_B)
-        self.show_dashboard(counts_A, counts_B, total_A, total_B)
-
-        outwb = openpyxl.Workbook()
-        wsA = outwb.active
-        wsA.title = "File1"
-        wsB = outwb.create_sheet("File2")
-        self.write_output_sheet(
-            wsA, row_info_A, used_headers1, opts, mapping, is_file1=True, 
-            export_mapped_only=self.export_mapped_only.get()
-        )
-        self.write_output_sheet(
-            wsB, row_info_B, used_headers2, opts, reverse_mapping, is_file1=False, 
-            export_mapped_only=self.export_mapped_only.get()
-        )
-        outwb.save(outname)
-        self.status_var.set(f"Output saved: {outname}")
-        self.update_recent_outputs(outname)
-        self.out_combo["values"] = self.recent_outputs
-
-        if self.export_match_types_separately.get():
-            base, ext = os.path.splitext(outname)
-            match_types = ["Full Match", "Partial Match", "No Match"]
-            for mt in match_types:
-                for which, row_info, headers, mapping, is_file1 in [
-                    ("file1", row_info_A, used_headers1, mapping, True),
-                    ("file2", row_info_B, used_headers2, reverse_mapping, False)
-                ]:
-                    rows = [row for row in row_info if row[1] == mt]
-                    if not rows: continue
-                    wb = openpyxl.Workbook()
-                    ws = wb.active
-                    ws.title = which.capitalize()
-                    self.write_output_sheet(
-                        ws, rows, headers, opts, mapping, is_file1=is_file1,
-                        export_mapped_only=self.export_mapped_only.get()
-                    )
-                    fname = f"{base}_{which}_{mt.replace(' ', '').lower()}{ext}"
-                    wb.save(fname)
-            messagebox.showinfo("Exported", "Separate files for each match type have been saved in the output directory.")
+        if self.batch_mode.get():
+            self.compare_batch(outname, opts)
+            return
+        if self.workbook_mode.get():
+            self.compare_workbooks(outname, opts)
+            return
 
+        # File prompts need the main thread, so the filtered output file is
+        # asked for before the run starts.
+        filter_type = self.filtered_output_type.get()
+        filtered_outname = None
+        filtered_skipped = False
         if self.filtered_output_enabled.get():
-            filter_type = self.filtered_output_type.get()
             filtered_outname = self.filtered_output_file_var.get()
             if not filtered_outname:
                 filtered_outname = filedialog.asksaveasfilename(defaultextension=".xlsx", filetypes=[("Excel files", "*.xlsx")])
-                if not filtered_outname:
-                    self.status_var.set("Filtered output not saved (file not selected).")
-                    return
-                self.filtered_output_file_var.set(filtered_outname)
-                self.update_recent_filtered_outputs(filtered_outname)
-                self.filter_output_combo["values"] = self.recent_filtered_outputs
-                self.save_settings()
-            filtered_rows_A = [row for row in row_info_A if row[1] == filter_type]
-            filtered_rows_B = [row for row in row_info_B if row[1] == filter_type]
-            filtered_wb = openpyxl.Workbook()
-            fwsA = filtered_wb.active
-            fwsA.title = "File1"
-            fwsB = filtered_wb.create_sheet("File2")
-            self.write_output_sheet(
-                fwsA, filtered_rows_A, used_headers1, opts, mapping, is_file1=True, 
-                export_mapped_only=self.export_mapped_only.get()
-            )
-            self.write_output_sheet(
-                fwsB, filtered_rows_B, used_headers2, opts, reverse_mapping, is_file1=False, 
-                export_mapped_only=self.export_mapped_only.get()
-            )
-            filtered_wb.save(filtered_outname)
+                if filtered_outname:
+                    self.filtered_output_file_var.set(filtered_outname)
+                    self.update_recent_filtered_outputs(filtered_outname)
+                    self.filter_output_combo["values"] = self.recent_filtered_outputs
+                    self.save_settings()
+                else:
+                    filtered_skipped = True
+
+        inputs = self.comparison_inputs()
+        sort_by_match = self.sort_by_match.get()
+        export_mapped_only = self.export_mapped_only.get()
+        separate = self.export_match_types_separately.get()
+        write_only = self.streaming_output.get()
+        workers = self.export_worker_count()
+        checked = self.memory_preflight(inputs, write_only)
+        if checked is None:
+            return
+        inputs, write_only = checked
+
+        def work(progress):
+            try:
+                used_headers1, used_headers2, mapping, result = self.run_comparison(inputs, progress)
+            except Cancelled:
+                raise
+            except Exception as e:
+                self.post(messagebox.showerror, "Error", f"Failed to open files:\n{e}")
+                return
+            reverse_mapping = result.reverse_mapping
+            layout = result.layout
+
+            if sort_by_match:
+                progress.start("Sorting", len(result.row_info_A) + len(result.row_info_B))
+                result.sort_by_match()
+                progress.advance(progress.total)
+            row_info_A, row_info_B = result.row_info_A, result.row_info_B
+
+            counts_A = result.counts(file1=True)
+            counts_B = result.counts(file1=False)
+            total_A = len(row_info_A)
+            total_B = len(row_info_B)
+
+            jobs = [(outname, [
+                ("File1", row_info_A, used_headers1, mapping, True, layout),
+                ("File2", row_info_B, used_headers2, reverse_mapping, False, layout),
+            ])]
+            if separate:
+                base, ext = os.path.splitext(outname)
+                for mt in MATCH_TYPES:
+                    for which, headers, sheet_mapping, is_file1 in [
+                        ("file1", used_headers1, mapping, True),
+                        ("file2", used_headers2, reverse_mapping, False)
+                    ]:
+                        rows = result.rows_with_status(mt, file1=is_file1)
+                        if not rows: continue
+                        fname = f"{base}_{which}_{mt.replace(' ', '').lower()}{ext}"
+                        jobs.append((fname, [(which.capitalize(), rows, headers, sheet_mapping, is_file1, layout)]))
+            if filtered_outname:
+                jobs.append((filtered_outname, [
+                    ("File1", result.rows_with_status(filter_type, file1=True), used_headers1, mapping, True, layout),
+                    ("File2", result.rows_with_status(filter_type, file1=False), used_headers2, reverse_mapping, False, layout),
+                ]))
+
+            saved = []
+            def on_saved(path):
+                saved.append(path)
+                self.post(self.status_var.set, f"Saved {len(saved)}/{len(jobs)}: {path}")
+            export_workbooks(jobs, opts, export_mapped_only, write_only=write_only,
+                             workers=workers, on_saved=on_saved, progress=progress)
+            progress.finish()
+            self.log_run("compare", inputs, progress, outputs=[path for path, _ in jobs],
+                         counts={"file1": counts_A, "file2": counts_B})
+            self.post(self.show_dashboard, counts_A, counts_B, total_A, total_B, progress.stage_timings())
+            self.post(self.finish_compare, outname, separate, filtered_outname, filtered_skipped)
+
+        self.start_job(work, self.profile_path(outname))
+
+    def compare_workbooks(self, outname, opts):
+        # Workbook mode: every sheet pair of the two files is compared, in a
+        # process pool when compare_workers allows, and written to one
+        # workbook behind a Summary sheet. Each pair uses the mapping profile
+        # named in the pairing table, else the profile in the profiles folder
+        # saved for its headers, else the current mapping when the headers
+        # are the same, else suggested mappings.
+        inputs = self.comparison_inputs()
+        path1, _, path2, _, _, normalizer, similarity, pair_rows, _ = inputs
+        table_path = self.pairing_table_var.get().strip()
+        profiles_dir = self.profiles_dir_var.get().strip()
+        current = (list(self.headers1), list(self.headers2), dict(self.mapping), list(self.include1), list(self.include2))
+        sort_by_match = self.sort_by_match.get()
+        export_mapped_only = self.export_mapped_only.get()
+        write_only = self.streaming_output.get()
+        workers = self.worker_count()
+        fast_reader = self.sheet_cache.fast_reader
+
+        def work(progress):
+            try:
+                table = read_pairing_table(table_path) if table_path else None
+                names1, headers1 = workbook_headers(path1, fast_reader)
+                names2, headers2 = workbook_headers(path2, fast_reader)
+            except Exception as e:
+                self.post(messagebox.showerror, "Error", f"Failed to open files:\n{e}")
+                return
+            pairs, unpaired = pair_sheets(names1, names2, table)
+            planned, notes = [], {}
+            for sheet1, sheet2, profile in pairs:
+                if sheet1 not in headers1 or sheet2 not in headers2:
+                    notes[(sheet1, sheet2)] = "Sheet not found"
+                    continue
+                try:
+                    planned.append(self.sheet_pair_job(path1, sheet1, headers1[sheet1], path2, sheet2,
+                                                       headers2[sheet2], profile, profiles_dir, current))
+                except Exception as e:
+                    notes[(sheet1, sheet2)] = f"Mapping profile: {e}"
+            for job in planned:
+                job.update(normalization=normalizer.settings(), similarity=similarity, pair_rows=pair_rows,
+                           fast_reader=fast_reader)
+            progress.start("Comparing sheets")
+            results = self.run_pair_jobs(planned, workers, progress)
+
+            taken = {"summary"}
+            sheets, summary_rows, dashboard = [], [], []
+            for sheet1, sheet2, _ in pairs:
+                job = next((j for j in planned if (j["sheet1"], j["sheet2"]) == (sheet1, sheet2)), None)
+                outcome = results.get((sheet1, sheet2)) if job else None
+                if outcome is None or "error" in outcome:
+                    note = notes.get((sheet1, sheet2)) or (outcome or {}).get("error", "")
+                    summary_rows.append([sheet1, sheet2, job["source"] if job else ""] + [None] * 10 + [note])
+                    dashboard.append(f"{sheet1} / {sheet2}: {note}")
+                    continue
+                result = ComparisonResult(outcome["data1"], outcome["data2"], job["mapping"],
+                                          [STATUS_LABELS[c] for c in outcome["statuses_A"]],
+                                          [STATUS_LABELS[c] for c in outcome["statuses_B"]],
+                                          normalizer=normalizer, **outcome["details"])
+                if sort_by_match:
+                    result.sort_by_match()
+                counts_A, counts_B = result.counts(file1=True), result.counts(file1=False)
+                total_A, total_B = len(result.row_info_A), len(result.row_info_B)
+                summary_rows.append(
+                    [sheet1, sheet2, job["source"], total_A] + [counts_A[mt] for mt in MATCH_TYPES]
+                    + [total_B] + [counts_B[mt] for mt in MATCH_TYPES] + [""])
+                dashboard.append(f"{sheet1} / {sheet2}: File 1 {counts_A['Full Match']:,}/{total_A:,} full, "
+                                 f"File 2 {counts_B['Full Match']:,}/{total_B:,} full")
+                sheets.append((output_sheet_title(sheet1, " (1)", taken), result.row_info_A, job["headers1"],
+                               job["mapping"], True, result.layout))
+                sheets.append((output_sheet_title(sheet2, " (2)", taken), result.row_info_B, job["headers2"],
+                               result.reverse_mapping, False, result.layout))
+            for which, name in unpaired:
+                row = [name, ""] if which == 1 else ["", name]
+                summary_rows.append(row + [""] + [None] * 10 + [f"Only in file {which}"])
+                dashboard.append(f"{name}: only in file {which}")
+            summary_headers = (["Sheet 1", "Sheet 2", "Mapping", "Rows 1"] + [f"{mt} 1" for mt in MATCH_TYPES]
+                               + ["Rows 2"] + [f"{mt} 2" for mt in MATCH_TYPES] + ["Note"])
+
+            progress.start("Writing", sum(len(sheet[1]) for sheet in sheets))
+            write_workbook(outname, sheets, opts, export_mapped_only, write_only, progress,
+                           summary=(summary_headers, summary_rows))
+            progress.finish()
+            self.log_run("workbook compare", inputs, progress, outputs=[outname],
+                         sheets=[dict(zip(summary_headers, row)) for row in summary_rows])
+            self.post(self.show_workbook_summary, dashboard, progress.stage_timings())
+            self.post(self.finish_compare, outname, False, None, False)
+
+        self.start_job(work, self.profile_path(outname))
+
+    def sheet_pair_job(self, path1, sheet1, headers1, path2, sheet2, headers2, profile, profiles_dir, current):
+        # The job compare_sheet_pair() runs for one pair, with the columns
+        # and mapping applied the way run_comparison() applies them.
+        if profile is None:
+            profile = find_mapping_profile(headers1, headers2, profiles_dir)
+        as_text = lambda headers: [str(h) for h in headers]
+        if profile is not None:
+            _, _, mapping, include1, include2 = read_mapping_profile(profile)
+            source = os.path.basename(profile)
+        elif current[0] and as_text(current[0]) == as_text(headers1) and as_text(current[1]) == as_text(headers2):
+            mapping, include1, include2 = current[2], current[3], current[4]
+            source = "Current mapping"
+        else:
+            try:
+                sketches = (self.sheet_cache.sketches(path1, sheet1), self.sheet_cache.sketches(path2, sheet2))
+            except Exception:
+                sketches = ()
+            mapping = suggest_mappings(as_text(headers1), as_text(headers2), *sketches)
+            include1, include2 = [], []
+            source = "Suggested"
+        if len(include1) != len(headers1): include1 = [True] * len(headers1)
+        if len(include2) != len(headers2): include2 = [True] * len(headers2)
+        cols1 = [i for i, v in enumerate(include1) if v]
+        cols2 = [i for i, v in enumerate(include2) if v]
+        return {
+            "path1": path1, "sheet1": sheet1, "path2": path2, "sheet2": sheet2,
+            "include1": cols1, "include2": cols2,
+            "headers1": [headers1[i] for i in cols1], "headers2": [headers2[i] for i in cols2],
+            "mapping": {k: v for k, v in mapping.items() if k in cols1 and v in cols2},
+            "source": source,
+        }
+
+    def run_pair_jobs(self, jobs, workers, progress):
+        # {(sheet1, sheet2): compare_sheet_pair() result}.
+        results = {}
+        def done(job, outcome):
+            results[(job["sheet1"], job["sheet2"])] = outcome
+            if "error" not in outcome:
+                progress.advance(max(0, len(outcome["data1"]) - 1) + max(0, len(outcome["data2"]) - 1))
+        if workers <= 1 or len(jobs) <= 1:
+            for job in jobs:
+                progress.check()
+                done(job, compare_sheet_pair(job))
+            return results
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+            pending = {pool.submit(compare_sheet_pair, job): job for job in jobs}
+            try:
+                while pending:
+                    finished, _ = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        done(pending.pop(future), future.result())
+                    progress.check()
+            except Cancelled:
+                for future in pending:
+                    future.cancel()
+                raise
+        return results
+
+    def compare_batch(self, outname, opts):
+        # Batch mode: File 1's sheet is the reference and every workbook in
+        # the batch folder is compared against it. The reference is loaded
+        # once and indexed once per pool worker (by init_batch_worker); the
+        # files are spread over compare_workers processes, each reading,
+        # comparing and writing its own output. Outputs are named after the
+        # output file ("out_<file>.xlsx", see batch_output_name()) and listed
+        # with their counts in "out_summary.csv".
+        directory = self.batch_dir_var.get().strip()
+        if not directory or not os.path.isdir(directory):
+            messagebox.showerror("Error", "Choose the folder of workbooks to compare against File 1.")
+            return
+        inputs = self.comparison_inputs()
+        path1, sheet1, path2, sheet2, _, normalizer, _, _, _ = inputs
+        base, ext = os.path.splitext(outname)
+        prefix = os.path.basename(base) + "_"
+        out_dir = os.path.dirname(os.path.abspath(outname))
+        try:
+            os.makedirs(out_dir, exist_ok=True)
+        except OSError as e:
+            messagebox.showerror("Error", f"Cannot create the output folder:\n{e}")
+            return
+        same_folder = os.path.samefile(directory, out_dir)
+        files = [path for path in batch_files(directory, skip=(path1, outname))
+                 if not (same_folder and os.path.basename(path).startswith(prefix))]
+        if not files:
+            messagebox.showinfo("Batch", f"No workbooks found in {directory}.")
+            return
+        summary_path = f"{base}_summary.csv"
+        sort_by_match = self.sort_by_match.get()
+        export_mapped_only = self.export_mapped_only.get()
+        write_only = self.streaming_output.get()
+        workers = self.worker_count()
+        fast_reader = self.sheet_cache.fast_reader
+
+        def work(progress):
+            try:
+                self.reload_headers(path1, sheet1, path2, sheet2)
+                current = (list(self.headers2), dict(self.mapping), list(self.include2))
+                include1 = [i for i, v in enumerate(self.include1) if v]
+                reference = self.sheet_cache.rows(path1, sheet1, progress, include1)
+            except Cancelled:
+                raise
+            except Exception as e:
+                self.post(messagebox.showerror, "Error", f"Failed to open files:\n{e}")
+                return
+            taken = set()
+            jobs = [{
+                "path": path, "sheet": sheet2, "include1": include1, "reference_headers": reference[0] if reference else [],
+                "current": current, "fast_reader": fast_reader, "sort_by_match": sort_by_match, "opts": opts,
+                "export_mapped_only": export_mapped_only, "write_only": write_only,
+                "output": f"{base}_{batch_output_name(path, taken)}{ext}",
+            } for path in files]
+            progress.start("Comparing files", len(jobs))
+            summaries = self.run_batch_jobs(jobs, reference, normalizer, workers, progress)
+            summaries.sort(key=lambda row: files.index(row["file"]))
+            write_batch_summary(summary_path, summaries)
+            progress.finish()
+            self.log_run("batch compare", inputs, progress, outputs=[summary_path] + [s["output"] for s in summaries if s["output"]],
+                         files=summaries)
+            lines = []
+            for row in summaries:
+                name = os.path.basename(row["file"])
+                if row["error"]:
+                    lines.append(f"{name}: {row['error']}")
+                else:
+                    lines.append(f"{name}: {row['counts']['Full Match']:,}/{row['rows']:,} full")
+            if len(lines) > 30:
+                lines[30:] = [f"… and {len(lines) - 30} more (see {os.path.basename(summary_path)})"]
+            self.post(self.show_workbook_summary, lines, progress.stage_timings(), "Batch Summary")
+            self.post(self.status_var.set, f"Compared {len(summaries)} files; summary saved: {summary_path}")
+
+        self.start_job(work, self.profile_path(outname))
+
+    def run_batch_jobs(self, jobs, reference, normalizer, workers, progress):
+        # compare_batch_file() for every job, in job order when run here.
+        results = []
+        if workers <= 1 or len(jobs) <= 1:
+            index = ReferenceIndex(reference, normalizer)
+            for job in jobs:
+                progress.check()
+                results.append(compare_batch_file(job, index))
+                progress.advance(1)
+            return results
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), initializer=init_batch_worker,
+                                 initargs=(reference, normalizer.settings())) as pool:
+            pending = {pool.submit(compare_batch_file, job) for job in jobs}
+            try:
+                while pending:
+                    finished, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        results.append(future.result())
+                        progress.advance(1)
+                    progress.check()
+            except Cancelled:
+                for future in pending:
+                    future.cancel()
+                raise
+        return results
+
+    def show_workbook_summary(self, lines, timings=None, title="Workbook Summary"):
+        msg = f"{title}:\n\n" + "\n".join(lines)
+        if timings:
+            msg += f"\n\nTimings:\n{format_timings(timings)}"
+        messagebox.showinfo("Comparison Summary", msg)
+
+    def finish_compare(self, outname, separate, filtered_outname, filtered_skipped):
+        self.status_var.set(f"Output saved: {outname}")
+        self.update_recent_outputs(outname)
+        self.out_combo["values"] = self.recent_outputs
+        if separate:
+            messagebox.showinfo("Exported", "Separate files for each match type have been saved in the output directory.")
+        if filtered_skipped:
+            self.status_var.set("Filtered output not saved (file not selected).")
+            return
+        if filtered_outname:
             self.status_var.set(f"Filtered output saved: {filtered_outname}")
             self.update_recent_filtered_outputs(filtered_outname)
             self.filter_output_combo["values"] = self.recent_filtered_outputs
@@ -964,71 +3917,54 @@ class ExcelComparatorApp:
         messagebox.showinfo("Saved", "Output files saved successfully.")
 
     def export_partial_match_rows(self):
-        self.reload_data1()
-        self.reload_data2()
-        try:
-            headers1, headers2 = self.headers1, self.headers2
-            data1, data2 = self.data1, self.data2
-            include1 = [i for i, v in enumerate(self.include1) if v]
-            include2 = [i for i, v in enumerate(self.include2) if v]
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to open files:\n{e}")
+        if self.job_running():
             return
-
-        mapping = {k: v for k, v in self.mapping.items() if k in include1 and v in include2}
-        reverse_mapping = {v: k for k, v in mapping.items()}
-        used_headers1 = [headers1[i] for i in include1]
-        used_headers2 = [headers2[i] for i in include2]
-        used_data1 = [[row[i] for i in include1] for row in data1]
-        used_data2 = [[row[i] for i in include2] for row in data2]
-        row_info_A = self.get_annotated_rows(used_data1, used_data2, mapping)
-        row_info_B = self.get_annotated_rows(used_data2, used_data1, reverse_mapping)
-
         from_opt = self.partial_from_var.get()
         outname = filedialog.asksaveasfilename(defaultextension=".xlsx", filetypes=[("Excel files", "*.xlsx")], title="Export Partial Match Rows")
         if not outname:
             return
 
-        opts = {
-            "header_font": self.header_font.get(),
-            "header_size": int(self.header_size.get()),
-            "header_fill": self.header_fill.get(),
-            "header_fontcolor": self.header_fontcolor.get(),
-            "header_border_thick": int(self.header_border_thick.get()),
-            "header_border_color": self.header_border_color.get(),
-            "body_font": self.body_font.get(),
-            "body_size": int(self.body_size.get()),
-            "body_fill": self.body_fill.get(),
-            "body_fontcolor": self.body_fontcolor.get(),
-            "body_border_thick": int(self.body_border_thick.get()),
-            "body_border_color": self.body_border_color.get(),
-            "match_highlight": self.match_highlight.get(),
-            "partial_highlight": self.partial_highlight.get(),
-            "nomatch_highlight": self.nomatch_highlight.get(),
-            "header_height": int(self.header_height.get()),
-            "body_height": int(self.body_height.get()),
-            "padding": int(self.padding.get())
-        }
+        opts = self.output_options()
         export_mapped_only = self.export_mapped_only.get()
-        outwb = openpyxl.Workbook()
-
-        if from_opt in ("File1", "Both"):
-            wsA = outwb.active
-            wsA.title = "File1"
-            partial_A = [row for row in row_info_A if row[1] == "Partial Match"]
-            self.write_output_sheet(wsA, partial_A, used_headers1, opts, mapping, is_file1=True, export_mapped_only=export_mapped_only)
-        if from_opt in ("File2", "Both"):
-            if from_opt == "Both":
-                wsB = outwb.create_sheet("File2")
-            else:
-                wsB = outwb.active
-                wsB.title = "File2"
-            partial_B = [row for row in row_info_B if row[1] == "Partial Match"]
-            self.write_output_sheet(wsB, partial_B, used_headers2, opts, reverse_mapping, is_file1=False, export_mapped_only=export_mapped_only)
+        write_only = self.streaming_output.get()
+        inputs = self.comparison_inputs()
+        checked = self.memory_preflight(inputs, write_only)
+        if checked is None:
+            return
+        inputs, write_only = checked
+
+        def work(progress):
+            try:
+                used_headers1, used_headers2, mapping, result = self.run_comparison(inputs, progress)
+            except Cancelled:
+                raise
+            except Exception as e:
+                self.post(messagebox.showerror, "Error", f"Failed to open files:\n{e}")
+                return
+            reverse_mapping = result.reverse_mapping
+
+            sheets = []
+            if from_opt in ("File1", "Both"):
+                partial_A = result.rows_with_status("Partial Match", file1=True)
+                sheets.append(("File1", partial_A, used_headers1, mapping, True, result.layout))
+            if from_opt in ("File2", "Both"):
+                partial_B = result.rows_with_status("Partial Match", file1=False)
+                sheets.append(("File2", partial_B, used_headers2, reverse_mapping, False, result.layout))
+
+            export_workbooks([(outname, sheets)], opts, export_mapped_only, write_only=write_only, progress=progress)
+            progress.finish()
+            self.log_run("partial export", inputs, progress, outputs=[outname],
+                         rows={title: len(rows) for title, rows, *_ in sheets})
+            self.post(self.finish_partial_export, outname, progress.stage_timings())
+
+        self.start_job(work, self.profile_path(outname))
 
-        outwb.save(outname)
+    def finish_partial_export(self, outname, timings=None):
         self.update_recent_outputs(outname)
-        messagebox.showinfo("Exported", f"Partial match rows exported to:\n{outname}")
+        msg = f"Partial match rows exported to:\n{outname}"
+        if timings:
+            msg += f"\n\nTimings:\n{format_timings(timings)}"
+        messagebox.showinfo("Exported", msg)
 
 if __name__ == "__main__":
     root = tk.Tk()
@@ -0,0 +1,20 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from excel_comparator_advanced import compare_sheets
+
+HEADER = ["A", "B", "C"]
+
+def test_partner_shares_common_values():
+    # B = "bc" and C = "cc" are each held by 300+ rows of File 2, yet only
+    # the last row holds both; it beats the row sharing the rare A value.
+    data1 = [HEADER, ["a1", "bc", "cc"]]
+    data2 = ([HEADER, ["a1", "zz", "zz"]]
+             + [["b%d" % i, "bc", "x%d" % i] for i in range(300)]
+             + [["c%d" % i, "y%d" % i, "cc"] for i in range(300)]
+             + [["zz", "bc", "cc"]])
+    result = compare_sheets(data1, data2, {0: 0, 1: 1, 2: 2}, pair_rows=True)
+    row = result.row_info_A[0]
+    assert row[2] == len(data2)
@@ -0,0 +1,35 @@
+import os
+import random
+import string
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from excel_comparator_advanced import HEADER_CUTOFF, header_grams, header_similarity, suggest_mappings
+
+HEADERS = ["Phone", "Email", "Name", "Address", "City", "State", "Country", "Amount", "Balance", "Status",
+           "Region", "Code", "Date", "Order", "Price", "Total", "Invoice", "Account", "Number", "Customer"]
+
+def one_typo(rng, word):
+    i = rng.randrange(len(word) - 1)
+    letter = rng.choice(string.ascii_lowercase)
+    return rng.choice([
+        word[:i] + letter + word[i + 1:],
+        word[:i] + word[i + 1:],
+        word[:i] + letter + word[i:],
+        word[:i] + word[i + 1] + word[i] + word[i + 2:],
+    ])
+
+def test_swapped_letters():
+    assert suggest_mappings(["Phone"], ["Phnoe"]) == {0: 0}
+
+def test_single_typos():
+    # Every pair header_similarity() scores as alike is suggested, however
+    # few trigrams the typo leaves in common.
+    rng = random.Random(0)
+    for _ in range(300):
+        header = rng.choice(HEADERS)
+        typo = one_typo(rng, header)
+        if header_similarity(*header_grams(header), *header_grams(typo)) < HEADER_CUTOFF:
+            continue
+        assert suggest_mappings([header, "Unrelated"], ["Other", typo]) == {0: 1}, (header, typo)